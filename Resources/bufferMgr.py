@@ -1,4 +1,5 @@
- 
+import os
+
 #######################################################################
 #                               Buffer info
 #######################################################################
@@ -19,12 +20,23 @@ class BufferItem:
         self.bufId = bufId
         self.path = path
 
+def normPath( path ):
+    '''Return the key of path in the buffer index: two spellings of the same
+    path have the same key.'''
+    return os.path.normcase( os.path.normpath( path ) )
+
 class BufferMgr:
+    '''The buffers opened in vim, in opening order.
+
+    Buffers are indexed by bufId and by normalized path. Their order is kept
+    as a ring of bufIds, linked both ways, so that finding the next buffer
+    and removing one do not depend on the number of buffers.
+    '''
 
     def __init__( self ):
-        self.bufferList = []    
         self.nextBufId = 1
         self.eventHandlerList = []
+        self.clear()
 
     def createBufId( self ):
         '''Create a new bufId for later use in addBuffer.'''
@@ -33,68 +45,114 @@ class BufferMgr:
         return bufId
         
     def addBuffer( self, bufId, path ):
-        '''Add a buffer, get a new bufId for it and return it.'''
-        if self.hasPath( path ): return self.bufIdOfPath( path )
+        '''Add a buffer, get a new bufId for it and return it.
+
+        The bufId of path is returned if path already has a buffer. A bufId
+        already present gets path as its new path, and keeps its place in
+        the opening order.'''
+        key = normPath( path )
+        item = self.itemOfPath.get( key )
+        if item: return item.bufId
+        item = self.itemOfBufId.get( bufId )
+        if item:
+            del self.itemOfPath[ normPath( item.path ) ]
+            item.path = path
+            self.itemOfPath[ key ] = item
+            return bufId
         item = BufferItem( bufId, path )
-        self.bufferList.append(  item )
+        self.itemOfBufId[ bufId ] = item
+        self.itemOfPath[ key ] = item
+        # link at the end of the ring
+        if self.headBufId is None:
+            self.headBufId = bufId
+            self.nextOf[ bufId ] = self.prevOf[ bufId ] = bufId
+        else:
+            last = self.prevOf[ self.headBufId ]
+            self.nextOf[ last ] = bufId
+            self.prevOf[ bufId ] = last
+            self.nextOf[ bufId ] = self.headBufId
+            self.prevOf[ self.headBufId ] = bufId
         self.notifyEvent( EVT_BUFFER_CREATED, (bufId, path ) )
         return bufId
 
     def rmBufferByBufId( self, bufId ):
         '''Remove the buffer identified with bufId.'''
-        target = [ (i,item) for (i,item) in enumerate(self.bufferList) if item.bufId == bufId ]
-        if len(target) == 0:
+        item = self.itemOfBufId.pop( bufId, None )
+        if item is None:
             raise IndexError( 'Could not find bufId %d' % bufId )
-        if len(target) > 1:
-            raise IndexError( 'More than one buffer with bufId %d' % bufId )
-        
-        i,item = target[0]
-        del self.bufferList[i]
+        del self.itemOfPath[ normPath( item.path ) ]
+        # unlink from the ring
+        prevId = self.prevOf.pop( bufId )
+        nextId = self.nextOf.pop( bufId )
+        if nextId == bufId:
+            self.headBufId = None
+        else:
+            self.nextOf[ prevId ] = nextId
+            self.prevOf[ nextId ] = prevId
+            if self.headBufId == bufId:
+                self.headBufId = nextId
         self.notifyEvent( EVT_BUFFER_DELETED, ( item.bufId, item.path ) )
 
     def firstBufId( self ):
-        if len(self.bufferList): 
-            return self.bufferList[0].bufId
-        else: 
-            return None
+        return self.headBufId
 
     def pathOfBufId( self, bufId ):
         '''Return the path associated with bufid.'''
-        return [ item.path for item in self.bufferList if item.bufId == bufId ][0]
+        item = self.itemOfBufId.get( bufId )
+        if item is None:
+            raise IndexError( 'No such bufId: %d' % bufId )
+        return item.path
 
     def bufIdOfPath( self, path ):
         '''Return the bufId associated with the path.'''
-        return [ item.bufId for item in self.bufferList if item.path == path ][0]
+        item = self.itemOfPath.get( normPath( path ) )
+        if item is None:
+            raise IndexError( 'No such path: %s' % path )
+        return item.bufId
 
     def hasBufId( self, bufId ):
         '''Return true if bufId already exists.'''
-        return len([ item for item in self.bufferList if item.bufId == bufId ]) >= 1
+        return bufId in self.itemOfBufId
         
     def hasPath( self, path ):
         '''Return true if path already exists.'''
-        return len([ item for item in self.bufferList if item.path == path ]) >= 1
+        return normPath( path ) in self.itemOfPath
 
     def nextBuffer( self, bufId ):
         '''Return the bufId after this bufId to activate the next buffer.'''
-        for i,item  in enumerate( self.bufferList ):
-            if item.bufId == bufId:
-                break
-        else:
+        if bufId not in self.nextOf:
             raise IndexError( 'No such bufId: %d' % bufId )
-        i = (i + 1) % len(self.bufferList)
-        return self.bufferList[i].bufId 
+        return self.nextOf[ bufId ]
 
     def clear( self ):
         '''Clear the content.'''
-        self.bufferList = []
+        self.itemOfBufId = {}
+        self.itemOfPath = {}        # normalized path -> item
+        self.nextOf = {}            # bufId -> next bufId in the ring
+        self.prevOf = {}            # bufId -> previous bufId in the ring
+        self.headBufId = None
         # should we reset nextBufId too ?
 
+    def buffers( self ):
+        '''Return the buffers as a list of BufferItem, in opening order.'''
+        items = []
+        bufId = self.headBufId
+        while bufId is not None:
+            items.append( self.itemOfBufId[ bufId ] )
+            bufId = self.nextOf[ bufId ]
+            if bufId == self.headBufId:
+                break
+        return items
+
+    # the buffers, in opening order, read as the former list attribute
+    bufferList = property( buffers )
+
     def bufferNb( self ):
         '''Return the number of buffer'''
-        return len(self.bufferList)
+        return len(self.itemOfBufId)
 
     def __str__(self):
-        return str(self.bufferList)
+        return str(self.buffers())
 
     def addEventHandler( self, eventHlr ):
         '''Add an event handler that will receive buffer creation and deletion events.
@@ -0,0 +1,176 @@
+class _SumTree:
+    '''Prefix sums of a list of counts, as a Fenwick tree: changing a count,
+    summing the counts before an index and searching a sum are O(log n).'''
+
+    def __init__( self, counts ):
+        self.n = len( counts )
+        self.tree = [ 0 ] + list( counts )
+        for i in range( 1, self.n + 1 ):
+            j = i + (i & -i)
+            if j <= self.n:
+                self.tree[ j ] += self.tree[ i ]
+        self.top = 1
+        while self.top * 2 <= self.n:
+            self.top *= 2
+
+    def add( self, i, delta ):
+        '''Add delta to the count of index i.'''
+        i += 1
+        while i <= self.n:
+            self.tree[ i ] += delta
+            i += i & -i
+
+    def sum( self, i ):
+        '''Return the sum of the counts before index i.'''
+        total = 0
+        while i > 0:
+            total += self.tree[ i ]
+            i -= i & -i
+        return total
+
+    def search( self, value ):
+        '''Return (i, sum( i )) for the first index i whose count brings the
+        sum above value, (n, total) if there is none.'''
+        i = 0
+        total = 0
+        step = self.top
+        while step:
+            if i + step <= self.n and total + self.tree[ i + step ] <= value:
+                i += step
+                total += self.tree[ i ]
+            step /= 2
+        return i, total
+
+class BufferText:
+    '''The text of a Vim buffer, kept as a list of blocks.
+
+    The length and the number of newlines of each block are kept in Fenwick
+    trees: an edit inside a block updates O(log n) nodes, and finding the
+    block of an offset or of a line is O(log n). The edits which add or drop
+    whole blocks rebuild the trees, that is once every blockSize characters
+    inserted or removed at most.
+
+    Offsets are byte based and start at 0, lines start at 1, columns start at
+    0 and are byte based, as in the netbeans protocol.
+
+    To use me:
+    text = BufferText( vimWrapper.text( bufId ) )
+    text.insert( offset, 'some text' )
+    text.remove( offset, length )
+    line, col = text.lineColOfOffset( offset )
+    '''
+
+    blockSize = 4096
+
+    def __init__( self, text='' ):
+        self.blocks = [ text[ i:i + self.blockSize ]
+                        for i in range( 0, len( text ), self.blockSize ) ]
+        self.size = len( text )
+        self.whole = text       # the whole text, None after an edit
+        self._rebuild()
+
+    def length( self ):
+        return self.size
+
+    def text( self ):
+        '''Return the whole text.'''
+        if self.whole is None:
+            self.whole = ''.join( self.blocks )
+        return self.whole
+
+    def insert( self, offset, text ):
+        '''Insert text at offset.'''
+        if offset < 0 or offset > self.size:
+            raise IndexError( 'Offset %d out of the text (length %d)' % (offset, self.size) )
+        if not text:
+            return
+        i, start = self._blockOf( offset )
+        block = self.blocks[ i ]
+        block = block[ :offset - start ] + text + block[ offset - start: ]
+        self.size += len( text )
+        self.whole = None
+        if len( block ) > 2 * self.blockSize:
+            self.blocks[ i:i + 1 ] = self._split( block )
+            self._rebuild()
+        else:
+            self._setBlock( i, block )
+
+    def remove( self, offset, length ):
+        '''Remove length characters from offset.'''
+        if offset < 0 or length < 0 or offset + length > self.size:
+            raise IndexError( 'Range %d+%d out of the text (length %d)' % (offset, length, self.size) )
+        if not length:
+            return
+        i, start = self._blockOf( offset )
+        j, end = self._blockOf( offset + length )
+        head = self.blocks[ i ][ :offset - start ]
+        tail = self.blocks[ j ][ offset + length - end: ]
+        self.size -= length
+        self.whole = None
+        if i == j:
+            self._setBlock( i, head + tail )
+        elif j == i + 1:
+            self._setBlock( i, head )
+            self._setBlock( j, tail )
+        else:
+            # whole blocks go away
+            self.blocks[ i:j + 1 ] = [ head, tail ]
+            self._rebuild()
+
+    def lineColOfOffset( self, offset ):
+        '''Return the (line, col) of offset.'''
+        if offset < 0 or offset > self.size:
+            raise IndexError( 'Offset %d out of the text (length %d)' % (offset, self.size) )
+        i, start = self._blockOf( offset )
+        block = self.blocks[ i ]
+        line = 1 + self.newlines.sum( i ) + block.count( '\n', 0, offset - start )
+        lineStart = block.rfind( '\n', 0, offset - start ) + 1
+        if lineStart:
+            return line, offset - start - lineStart
+        # the line starts in a previous block
+        return line, offset - self._offsetOfLine( line )
+
+    def offsetOfLineCol( self, line, col ):
+        '''Return the offset of (line, col).'''
+        return self._offsetOfLine( line ) + col
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _split( self, block ):
+        return [ block[ i:i + self.blockSize ] for i in range( 0, len( block ), self.blockSize ) ]
+
+    def _rebuild( self ):
+        '''Drop the empty blocks and build the trees again.'''
+        self.blocks = [ block for block in self.blocks if block ] or [ '' ]
+        self.lengths = _SumTree( [ len( block ) for block in self.blocks ] )
+        self.newlines = _SumTree( [ block.count( '\n' ) for block in self.blocks ] )
+
+    def _setBlock( self, i, block ):
+        old = self.blocks[ i ]
+        self.lengths.add( i, len( block ) - len( old ) )
+        self.newlines.add( i, block.count( '\n' ) - old.count( '\n' ) )
+        self.blocks[ i ] = block
+
+    def _blockOf( self, offset ):
+        '''Return (index, start) of the block holding offset, the last
+        block for the end of the text.'''
+        i, start = self.lengths.search( offset )
+        if i == len( self.blocks ):
+            i -= 1
+            start = self.size - len( self.blocks[ i ] )
+        return i, start
+
+    def _offsetOfLine( self, line ):
+        if line < 1 or line > 1 + self.newlines.sum( len( self.blocks ) ):
+            raise IndexError( 'No line %d' % line )
+        if line == 1:
+            return 0
+        # block holding the newline ending the previous line
+        i, before = self.newlines.search( line - 2 )
+        block = self.blocks[ i ]
+        pos = -1
+        for n in range( line - 1 - before ):
+            pos = block.find( '\n', pos + 1 )
+        return self.lengths.sum( i ) + pos + 1
@@ -1 +1,28 @@
 vimExec  = 'c:/Program Files/gvim73/gvim.exe'
+
+
+# list only the immediate children of a directory, and fetch the content of
+# sub folders when they are expanded. Off by default: the whole tree is
+# listed, streamed to the table as it is scanned.
+lazyListup = False
+
+# render only the rows visible in the table viewport, the tree being kept in
+# the explorer. Folders are loaded when they are expanded.
+virtualRows = False
+
+# number of Vim windows the files are opened in. The files are spread over
+# them, a file already opened is shown in its window.
+vimInstances = 1
+
+# keep a copy of the text of the opened files, in sync with Vim, instead of
+# asking Vim for it each time
+mirrorBuffers = False
+
+# order of the entries of a folder: name, natural, extension, size or mtime
+treeOrder = 'name'
+
+# entries hidden from the tree, the quick-open and the search, as .gitignore
+# patterns matched against the entry names. The .gitignore files of the
+# folders are applied too when useGitignore is set.
+ignorePatterns = [ '.git/', '.hg/', '.svn/', 'node_modules/', '__pycache__/', '*.pyc', '*.pyo' ]
+useGitignore = True
@@ -0,0 +1,345 @@
+import os
+import re
+import sys
+import mmap
+import time
+import atexit
+import threading
+
+from xml.sax.saxutils import escape, quoteattr
+
+from logSystem import *
+from treeScanner import TreeScanner
+
+dbg = getLogger('ContentSearch').debug
+
+# files bigger than this are mapped instead of read
+mmapSize = 256 * 1024
+# a file with a NUL byte in its first bytes is binary, like git does
+binaryCheckSize = 8000
+# at most this many hits per file, and this many characters of each line
+maxFileHits = 100
+maxLineLength = 200
+# seconds given to the worker processes to run a first task, before
+# searching in threads instead
+poolStartTimeout = 5
+
+def searchFile( regex, path ):
+    '''Return the hits of the compiled regex in the file path, as a list of
+    (path, line, col, text): line starts at 1, col is the byte offset of the
+    hit in the line, text is the line. Only the first hit of a line is
+    reported. Binary and unreadable files have no hits.'''
+    try:
+        f = open( path, 'rb' )
+    except IOError:
+        return []
+    try:
+        try:
+            size = os.fstat( f.fileno() ).st_size
+            if size == 0:
+                return []
+            if size >= mmapSize:
+                data = mmap.mmap( f.fileno(), 0, access=mmap.ACCESS_READ )
+            else:
+                data = f.read()
+        except (IOError, OSError, EnvironmentError):
+            return []
+    finally:
+        f.close()
+
+    try:
+        if '\0' in data[ :binaryCheckSize ]:
+            return []
+        return _searchData( regex, path, data )
+    finally:
+        if isinstance( data, mmap.mmap ):
+            data.close()
+
+def _searchData( regex, path, data ):
+    hits = []
+    line = 1
+    counted = 0
+    pos = 0
+    end = len( data )
+    while pos <= end and len( hits ) < maxFileHits:
+        mo = regex.search( data, pos )
+        if not mo:
+            break
+        start = mo.start()
+        line += data[ counted:start ].count( '\n' )
+        lineStart = data.rfind( '\n', 0, start ) + 1
+        lineEnd = data.find( '\n', start )
+        if lineEnd < 0:
+            lineEnd = end
+        counted = lineStart
+        hits.append( (path, line, start - lineStart,
+            data[ lineStart:min( lineEnd, lineStart + maxLineLength ) ]) )
+        # next line
+        pos = lineEnd + 1
+    return hits
+
+_pool = None
+_poolLock = threading.Lock()
+
+def hitHtml( path, line, col, text ):
+    '''Return the <li> item of a hit, holding its path, line and column.
+
+    The item is a UTF-8 byte string, like the rows of the file table: the
+    text of the line is decoded and encoded back, its invalid bytes being
+    replaced.'''
+    if isinstance( path, unicode ):
+        path = path.encode( 'utf-8' )
+    text = text.decode( 'utf-8', 'replace' ).strip().encode( 'utf-8' )
+    return '<li data-path=%s data-line="%d" data-col="%d"><span class="hitPlace">%s:%d</span> %s</li>' % (
+        quoteattr( path ), line, col, escape( os.path.basename( path ) ), line, escape( text ) )
+
+def sharedPool( processes=None ):
+    '''Return the pool of workers shared by all the searches, created on
+    first use with processes workers. The pool is closed when python exits.
+
+    The worker processes must run a first task within poolStartTimeout
+    seconds. When they can not be created or do not, as may happen in an
+    embedded interpreter, the pool is made of threads.'''
+    global _pool
+    _poolLock.acquire()
+    try:
+        if _pool is None:
+            _pool = _processPool( processes )
+            if _pool is None:
+                from multiprocessing.pool import ThreadPool
+                _pool = ThreadPool( processes or 4 )
+            atexit.register( closePool )
+        return _pool
+    finally:
+        _poolLock.release()
+
+def _processPool( processes ):
+    '''Return a pool of processes whose workers have been checked to run,
+    None if there is none.'''
+    if os.name != 'posix' and not os.path.basename( sys.executable ).lower().startswith( 'python' ):
+        # the workers would be started with sys.executable
+        dbg( 'No process pool, %s is not python', sys.executable )
+        return None
+    try:
+        from multiprocessing import Pool
+        pool = Pool( processes )
+    except (ImportError, OSError, NotImplementedError), e:
+        dbg( 'No process pool, searching in threads: %s', e )
+        return None
+    try:
+        pool.apply_async( _probe ).get( poolStartTimeout )
+    except Exception, e:
+        dbg( 'Process pool not working, searching in threads: %r', e )
+        pool.terminate()
+        return None
+    return pool
+
+def _probe():
+    return os.getpid()
+
+def closePool():
+    '''Stop the workers of the shared pool.'''
+    global _pool
+    _poolLock.acquire()
+    try:
+        if _pool is not None:
+            _pool.terminate()
+            _pool.join()
+            _pool = None
+    finally:
+        _poolLock.release()
+
+def searchFiles( args ):
+    '''Pool task: return the hits of pattern in the files of paths.'''
+    pattern, flags, paths = args
+    regex = re.compile( pattern, flags )
+    hits = []
+    for path in paths:
+        hits.extend( searchFile( regex, path ) )
+    return hits
+
+
+class ContentSearch:
+    '''grep over a directory tree, on a pool of worker processes.
+
+    The tree is walked with a TreeScanner in a background thread, its files
+    being handed to the pool in chunks. The hits are collected as the chunks
+    complete, and fetched by the caller with takeHits() while the search
+    runs: nothing blocks the caller.
+
+    Starting a new search, or cancel(), abandons the running one: the walk
+    stops and the hits of the chunks still in the pool are dropped.
+
+    The pool is shared by all the searches, see sharedPool().
+
+    To use me:
+    search = ContentSearch( index )
+    search.start( topdir, pattern )
+    while search.isRunning():
+        hits = search.takeHits()
+        ...
+    '''
+
+    chunkFiles = 64
+    maxHits = 10000
+
+    def __init__( self, index, processes=None ):
+        self.index = index
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.running = False
+        self.hits = []
+        self.hitNb = 0
+
+    def start( self, topdir, pattern ):
+        '''Search the files under topdir for the regular expression pattern,
+        in the background. The search ignores case when pattern has no upper
+        case letter.
+
+        Raise re.error if pattern is not a valid regular expression.
+        '''
+        flags = re.MULTILINE
+        if pattern == pattern.lower():
+            flags |= re.IGNORECASE
+        re.compile( pattern, flags )
+
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.hits = []
+            self.hitNb = 0
+            self.running = True
+            generation = self.generation
+        finally:
+            self.lock.release()
+        thread = threading.Thread( target=self._run, args=(topdir, pattern, flags, generation) )
+        thread.setDaemon( True )
+        thread.start()
+
+    def cancel( self ):
+        '''Abandon the running search.'''
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.running = False
+        finally:
+            self.lock.release()
+
+    def isRunning( self ):
+        return self.running
+
+    def takeHits( self ):
+        '''Return the hits found since the last call, as a list of
+        (path, line, col, text).'''
+        self.lock.acquire()
+        try:
+            hits = self.hits
+            self.hits = []
+        finally:
+            self.lock.release()
+        return hits
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _chunks( self, topdir, pattern, flags, generation ):
+        '''Generate the pool tasks for the files under topdir, until the
+        search is abandoned.'''
+        paths = []
+        for root, dirs, files in TreeScanner( self.index ).walk( topdir ):
+            if generation != self.generation or self.hitNb >= self.maxHits:
+                return
+            for name in files:
+                paths.append( os.path.join( root, name ) )
+                if len( paths ) >= self.chunkFiles:
+                    yield (pattern, flags, paths)
+                    paths = []
+        if paths:
+            yield (pattern, flags, paths)
+
+    def _run( self, topdir, pattern, flags, generation ):
+        try:
+            # created here, checking the workers does not wait in the caller
+            pool = sharedPool( self.processes )
+            tasks = self._chunks( topdir, pattern, flags, generation )
+            for hits in pool.imap_unordered( searchFiles, tasks ):
+                self.lock.acquire()
+                try:
+                    if generation != self.generation:
+                        return
+                    self.hits.extend( hits )
+                    self.hitNb += len( hits )
+                    if self.hitNb >= self.maxHits:
+                        dbg( 'Too many hits, search stopped' )
+                        return
+                finally:
+                    self.lock.release()
+        finally:
+            self.lock.acquire()
+            try:
+                if generation == self.generation:
+                    self.running = False
+            finally:
+                self.lock.release()
+
+
+def _benchmark( topdir, pattern ):
+    '''Compare a sequential search with ContentSearch.'''
+    from dirIndex import DirIndex
+
+    regex = re.compile( pattern, re.MULTILINE )
+    t = time.time()
+    nb = 0
+    for root, dirs, files in os.walk( topdir ):
+        for name in files:
+            nb += len( searchFile( regex, os.path.join( root, name ) ) )
+    tSeq = time.time() - t
+    print 'sequential:    %7.3f s, %d hits' % (tSeq, nb)
+
+    search = ContentSearch( DirIndex() )
+    t = time.time()
+    search.start( topdir, pattern )
+    nb = 0
+    first = None
+    while search.isRunning():
+        hits = search.takeHits()
+        if hits and first is None:
+            first = time.time() - t
+        nb += len( hits )
+        time.sleep( 0.01 )
+    nb += len( search.takeHits() )
+    tPool = time.time() - t
+    print 'ContentSearch: %7.3f s, %d hits, first hits after %.3f s, x%.2f' % (
+        tPool, nb, first or 0, tSeq / tPool)
+
+def _checkHits():
+    '''Search a file with a non-ASCII name and content, check its hits.'''
+    import tempfile, shutil
+    from dirIndex import DirIndex
+
+    topdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join( topdir, '\xe3\x83\xa1\xe3\x83\xa2.txt' )
+        f = open( path, 'wb' )
+        f.write( 'caf\xc3\xa9 \xff <found>\nnothing\n' )
+        f.close()
+        search = ContentSearch( DirIndex() )
+        search.start( topdir, 'found' )
+        while search.isRunning():
+            time.sleep( 0.01 )
+        items = [ hitHtml( *hit ) for hit in search.takeHits() ]
+        assert items == [ '<li data-path="%s" data-line="1" data-col="9"><span class="hitPlace">'
+                          '\xe3\x83\xa1\xe3\x83\xa2.txt:1</span> caf\xc3\xa9 \xef\xbf\xbd &lt;found&gt;</li>'
+                          % path ], items
+        print 'hits of a non-ASCII file: ok'
+    finally:
+        shutil.rmtree( topdir )
+
+if __name__ == '__main__':
+    if len( sys.argv ) == 3:
+        # python contentSearch.py topdir pattern
+        _benchmark( sys.argv[1], sys.argv[2] )
+    else:
+        _checkHits()
@@ -0,0 +1,143 @@
+import os
+import time
+import threading
+
+from logSystem import *
+from treeScanner import scanDir
+
+dbg = getLogger('DirIndex').debug
+
+class DirIndex:
+    '''An in-process index of directory listings, keyed by path.
+
+    Each directory is stored with its mtime, its sub folders and its files,
+    both sorted by name. A directory is read again only when its mtime has
+    changed since it was indexed, so listing an already indexed tree costs
+    one stat() per directory instead of a full scan.
+
+    The index holds at most maxDirs directories. When it grows over that
+    bound, the least recently used directories are dropped.
+
+    If IgnoreRules are given, the ignored entries are dropped from the
+    listings before they are indexed: walks never read ignored folders.
+
+    The index may be shared by several threads: its state is only read and
+    written under its lock, the folders being read out of it.
+
+    To use me:
+    index = DirIndex()
+    dirs, files = index.listDir( path )
+    for root, dirs, files in index.walk( topdir ):
+        ...
+    '''
+
+    # a directory modified less than this many seconds before it was read may
+    # change again without its mtime changing (coarse mtime resolution).
+    racyDelay = 2
+
+    def __init__( self, maxDirs=20000, ignore=None ):
+        self.maxDirs = maxDirs
+        self.ignore = ignore
+        self.dirMap = {}     # path -> [ lastUse, mtime, dirs, files, links ]
+        self.tick = 0
+        self.lock = threading.Lock()
+
+    def listDir( self, path ):
+        '''Return (dirs, files) for the directory path, both sorted. The lists
+        are shared with the index and must not be modified.
+
+        Raise OSError if path can not be read.
+        '''
+        return self.listDirLinks( path )[:2]
+
+    def listDirLinks( self, path ):
+        '''Return (dirs, files, links) for the directory path, links being the
+        folders of dirs which are symbolic links. See scanDir().'''
+        mtime = os.stat( path ).st_mtime
+        self.lock.acquire()
+        try:
+            self.tick += 1
+            tick = self.tick
+            entry = self.dirMap.get( path )
+            if entry and entry[1] == mtime:
+                entry[0] = tick
+                return entry[2], entry[3], entry[4]
+        finally:
+            self.lock.release()
+
+        dirs, files, links = scanDir( path )
+        if self.ignore:
+            dirs, files, links = self.ignore.filter( path, dirs, files, links )
+        if time.time() - mtime < self.racyDelay:
+            # do not trust the mtime, read it again next time
+            mtime = None
+        self.lock.acquire()
+        try:
+            self.dirMap[ path ] = [ tick, mtime, dirs, files, links ]
+            if len( self.dirMap ) > self.maxDirs:
+                self._evict()
+        finally:
+            self.lock.release()
+        return dirs, files, links
+
+    def walk( self, topdir ):
+        '''Generate (root, dirs, files) for topdir and all its sub folders,
+        top-down, like os.walk(). Symbolic links to folders are listed but
+        not followed, unreadable folders are skipped.'''
+        try:
+            dirs, files, links = self.listDirLinks( topdir )
+        except OSError:
+            return
+        yield topdir, dirs, files
+        for dir_ in dirs:
+            if dir_ in links:
+                continue
+            for item in self.walk( os.path.join( topdir, dir_ ) ):
+                yield item
+
+    def invalidate( self, path ):
+        '''Forget about path, it will be read again on next access.'''
+        self.lock.acquire()
+        try:
+            if path in self.dirMap:
+                del self.dirMap[ path ]
+        finally:
+            self.lock.release()
+
+    def invalidateTree( self, path ):
+        '''Forget about path and all the folders below it.'''
+        prefix = os.path.join( path, '' )
+        self.lock.acquire()
+        try:
+            for p in self.dirMap.keys():
+                if p == path or p.startswith( prefix ):
+                    del self.dirMap[ p ]
+        finally:
+            self.lock.release()
+
+    def clear( self ):
+        '''Clear the content.'''
+        self.lock.acquire()
+        try:
+            self.dirMap = {}
+        finally:
+            self.lock.release()
+        if self.ignore:
+            self.ignore.clear()
+
+    def dirNb( self ):
+        '''Return the number of indexed directories.'''
+        return len( self.dirMap )
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _evict( self ):
+        '''Drop the least recently used quarter of the index.'''
+        byUse = sorted( self.dirMap.items(), key=lambda item: item[1][0] )
+        nbDrop = len( byUse ) - self.maxDirs * 3 / 4
+        dbg( 'Dropping %d directories from the index', nbDrop )
+        for path, entry in byUse[ :nbDrop ]:
+            del self.dirMap[ path ]
+
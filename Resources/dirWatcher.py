@@ -0,0 +1,277 @@
+import os
+import sys
+import time
+import errno
+import struct
+import threading
+
+from logSystem import *
+
+dbg = getLogger('DirWatcher').debug
+err = getLogger('DirWatcher').error
+
+class DirWatcherError( Exception ): pass
+
+
+class DirWatcher:
+    '''Base class of the directory watchers.
+
+    A watcher is given the directories currently displayed with watch() and
+    unwatch(). readChanges() is meant to be called regularly: it returns the
+    list of watched directories whose content has changed: an entry was
+    added, removed or renamed, or one of the files of contentNames was
+    modified.
+
+    Events are coalesced by directory: a burst of events (a checkout touching
+    thousands of files for example) is reported once the event stream has
+    been quiet for settleDelay seconds, or at the latest after maxDelay seconds,
+    with each directory appearing only once.
+
+    At most maxWatches directories are watched, the next ones are not
+    updated until some are unwatched.
+
+    Subclasses implement _readEvents(), _addWatch() and _rmWatch().
+    '''
+
+    settleDelay = 0.3
+    maxDelay = 2.0
+    maxWatches = 2000
+
+    # the modification of these files changes the content displayed
+    contentNames = ( '.gitignore', )
+
+    def __init__( self ):
+        self.watched = {}       # path -> watch descriptor
+        self.pending = {}       # path -> True
+        self.firstEvent = 0
+        self.lastEvent = 0
+        self.full = False       # no more watch can be added
+
+    def watch( self, path ):
+        '''Start watching the content of the directory path.'''
+        if path in self.watched or self.full:
+            return
+        if len( self.watched ) >= self.maxWatches:
+            err( 'More than %d folders displayed, the next ones are not watched' % self.maxWatches )
+            self.full = True
+            return
+        try:
+            self.watched[ path ] = self._addWatch( path )
+        except (OSError, DirWatcherError), e:
+            # permission denied, ...: the folder will not be updated
+            err( 'Can not watch \'%s\': %s' % (path, str(e)) )
+            if getattr( e, 'errno', None ) == errno.ENOSPC:
+                # out of inotify watches: the next ones would fail as well
+                self.full = True
+
+    def isWatched( self, path ):
+        return path in self.watched
+
+    def unwatch( self, path ):
+        '''Stop watching the directory path.'''
+        wd = self.watched.pop( path, None )
+        if wd is not None:
+            self._rmWatch( path, wd )
+            self.full = False
+        if path in self.pending:
+            del self.pending[ path ]
+
+    def unwatchAll( self ):
+        '''Stop watching all the directories.'''
+        for path in self.watched.keys():
+            self.unwatch( path )
+
+    def readChanges( self ):
+        '''Return the sorted list of watched directories which have changed
+        since the last call, or an empty list while events are still coming.'''
+        now = time.time()
+        for path in self._readEvents():
+            if path is None:
+                # events were lost, consider that everything has changed
+                for p in self.watched:
+                    self.pending[ p ] = True
+            elif path in self.watched:
+                self.pending[ path ] = True
+            else:
+                continue
+            if not self.firstEvent:
+                self.firstEvent = now
+            self.lastEvent = now
+
+        if not self.pending:
+            return []
+        if now - self.lastEvent < self.settleDelay and now - self.firstEvent < self.maxDelay:
+            return []
+        changes = self.pending.keys()
+        changes.sort()
+        self.pending = {}
+        self.firstEvent = 0
+        return changes
+
+    def close( self ):
+        self.unwatchAll()
+
+
+class InotifyWatcher( DirWatcher ):
+    '''Directory watcher based on Linux inotify, accessed through ctypes.'''
+
+    IN_CLOSE_WRITE  = 0x00000008
+    IN_MOVED_FROM   = 0x00000040
+    IN_MOVED_TO     = 0x00000080
+    IN_CREATE       = 0x00000100
+    IN_DELETE       = 0x00000200
+    IN_DELETE_SELF  = 0x00000400
+    IN_MOVE_SELF    = 0x00000800
+    IN_Q_OVERFLOW   = 0x00004000
+    IN_IGNORED      = 0x00008000
+    IN_ONLYDIR      = 0x01000000
+
+    watchMask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+    eventHeader = 'iIII'    # wd, mask, cookie, len
+
+    def __init__( self ):
+        DirWatcher.__init__( self )
+        if not sys.platform.startswith( 'linux' ):
+            raise DirWatcherError( 'inotify is only available on Linux' )
+        try:
+            import ctypes, ctypes.util, fcntl
+            self.libc = ctypes.CDLL( ctypes.util.find_library( 'c' ), use_errno=True )
+            self.ctypes = ctypes
+            self.fd = self.libc.inotify_init()
+        except (ImportError, OSError, AttributeError), e:
+            raise DirWatcherError( 'inotify is not available: %s' % str(e) )
+        if self.fd < 0:
+            raise DirWatcherError( 'inotify_init failed: %s' % os.strerror( ctypes.get_errno() ) )
+        flags = fcntl.fcntl( self.fd, fcntl.F_GETFL )
+        fcntl.fcntl( self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK )
+        self.pathOfWd = {}
+        self.headerSize = struct.calcsize( self.eventHeader )
+
+    def close( self ):
+        DirWatcher.close( self )
+        os.close( self.fd )
+
+    def _addWatch( self, path ):
+        wd = self.libc.inotify_add_watch( self.fd, path, self.watchMask )
+        if wd < 0:
+            eno = self.ctypes.get_errno()
+            raise OSError( eno, os.strerror( eno ) )
+        self.pathOfWd[ wd ] = path
+        return wd
+
+    def _rmWatch( self, path, wd ):
+        if self.pathOfWd.pop( wd, None ) is not None:
+            self.libc.inotify_rm_watch( self.fd, wd )
+
+    def _readEvents( self ):
+        paths = []
+        while 1:
+            try:
+                buf = os.read( self.fd, 65536 )
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+            if not buf:
+                break
+            offset = 0
+            while offset < len( buf ):
+                wd, mask, cookie, length = struct.unpack_from( self.eventHeader, buf, offset )
+                name = buf[ offset + self.headerSize:offset + self.headerSize + length ].rstrip( '\0' )
+                offset += self.headerSize + length
+                if mask & self.IN_CLOSE_WRITE:
+                    # only the files of contentNames matter
+                    if name in self.contentNames:
+                        paths.append( self.pathOfWd.get( wd ) or '' )
+                elif mask & self.IN_Q_OVERFLOW:
+                    dbg( 'Event queue overflow' )
+                    paths.append( None )
+                elif mask & self.IN_IGNORED:
+                    # watch removed by the kernel, the folder is gone
+                    path = self.pathOfWd.pop( wd, None )
+                    if path is not None and self.watched.get( path ) == wd:
+                        del self.watched[ path ]
+                else:
+                    paths.append( self.pathOfWd.get( wd ) or '' )
+        return paths
+
+
+class PollWatcher( DirWatcher ):
+    '''Stand-in for platforms without inotify: compare the mtime of the
+    watched directories, and of their files of contentNames, every
+    pollInterval seconds.
+
+    The comparison runs in a background thread, readChanges() only takes the
+    directories found changed: the caller does not wait for the stats.'''
+
+    pollInterval = 1.0
+    maxWatches = 500
+
+    def __init__( self ):
+        DirWatcher.__init__( self )
+        self.lock = threading.Lock()
+        self.changed = []       # directories found changed by the thread
+        self.stopped = threading.Event()
+        thread = threading.Thread( target=self._poll )
+        thread.setDaemon( True )
+        thread.start()
+
+    def close( self ):
+        DirWatcher.close( self )
+        self.stopped.set()
+
+    def _addWatch( self, path ):
+        return self._mtime( path )
+
+    def _rmWatch( self, path, wd ):
+        pass
+
+    def _readEvents( self ):
+        self.lock.acquire()
+        try:
+            paths = self.changed
+            self.changed = []
+        finally:
+            self.lock.release()
+        return paths
+
+    def _poll( self ):
+        # path -> last mtime seen, starting from the one taken by watch()
+        mtimes = {}
+        while not self.stopped.wait( self.pollInterval ):
+            watched = self.watched.copy()
+            for path in mtimes.keys():
+                if path not in watched:
+                    del mtimes[ path ]
+            changed = []
+            for path, mtime in watched.iteritems():
+                newMtime = self._mtime( path )
+                if newMtime != mtimes.get( path, mtime ):
+                    changed.append( path )
+                mtimes[ path ] = newMtime
+            if changed:
+                self.lock.acquire()
+                try:
+                    self.changed.extend( changed )
+                finally:
+                    self.lock.release()
+
+    def _mtime( self, path ):
+        mtimes = []
+        for p in [ path ] + [ os.path.join( path, name ) for name in self.contentNames ]:
+            try:
+                mtimes.append( os.stat( p ).st_mtime )
+            except OSError:
+                mtimes.append( 0 )
+        return tuple( mtimes )
+
+
+def createDirWatcher():
+    '''Return the best directory watcher available on this platform.'''
+    try:
+        return InotifyWatcher()
+    except DirWatcherError, e:
+        dbg( 'Using polling directory watcher: %s', str(e) )
+        return PollWatcher()
+
@@ -0,0 +1,262 @@
+import os
+import re
+import threading
+
+from logSystem import *
+
+dbg = getLogger('IgnoreRules').debug
+
+def translatePattern( pattern ):
+    '''Return the regular expression matching the paths ignored by the
+    .gitignore pattern, paths being relative to the folder of the pattern and
+    separated with /. The leading ! and the trailing / must be removed.'''
+    anchored = '/' in pattern
+    pattern = pattern.lstrip( '/' )
+    i = 0
+    n = len( pattern )
+    res = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith( '**/', i ):
+            res.append( '(?:.*/)?' )
+            i += 3
+            continue
+        if pattern.startswith( '**', i ):
+            res.append( '.*' )
+            i += 2
+            continue
+        i += 1
+        if c == '*':
+            res.append( '[^/]*' )
+        elif c == '?':
+            res.append( '[^/]' )
+        elif c == '[':
+            j = pattern.find( ']', i + 1 )
+            if j < 0:
+                res.append( '\\[' )
+            else:
+                chars = pattern[ i:j ].replace( '\\', '\\\\' )
+                if chars.startswith( '!' ):
+                    chars = '^' + chars[1:]
+                res.append( '[%s]' % chars )
+                i = j + 1
+        elif c == '\\' and i < n:
+            res.append( re.escape( pattern[i] ) )
+            i += 1
+        else:
+            res.append( re.escape( c ) )
+    if anchored:
+        return ''.join( res ) + '$'
+    return '(?:.*/)?' + ''.join( res ) + '$'
+
+def compilePatterns( lines ):
+    '''Compile .gitignore lines into a list of (negate, fileRegex, dirRegex).
+
+    Consecutive patterns of the same polarity are merged in a single regular
+    expression. fileRegex only holds the patterns which apply to files,
+    dirRegex all of them. Either may be None.'''
+    groups = []
+    current = None
+    for line in lines:
+        line = line.rstrip( '\r\n' )
+        if not line.endswith( '\\ ' ):
+            line = line.rstrip()
+        if not line or line.startswith( '#' ):
+            continue
+        negate = line.startswith( '!' )
+        if negate:
+            line = line[1:]
+        dirOnly = line.endswith( '/' )
+        line = line.rstrip( '/' )
+        if not line:
+            continue
+        if current is None or current[0] != negate:
+            current = (negate, [], [])
+            groups.append( current )
+        regex = translatePattern( line )
+        if not dirOnly:
+            current[1].append( regex )
+        current[2].append( regex )
+
+    compiled = []
+    for negate, fileRegexes, dirRegexes in groups:
+        compiled.append( (negate, _compileAlternation( fileRegexes ),
+            _compileAlternation( dirRegexes )) )
+    return compiled
+
+def _compileAlternation( regexes ):
+    if not regexes:
+        return None
+    return re.compile( '|'.join( [ '(?:%s)' % r for r in regexes ] ) )
+
+
+class IgnoreRules:
+    '''.gitignore-style rules, deciding which entries of a folder are hidden.
+
+    The user patterns apply everywhere. The patterns of a .gitignore file
+    apply to the folder holding it and to its sub folders, and come after
+    the patterns of the parent folders: the last matching pattern decides,
+    a pattern starting with ! shows again what was ignored before.
+
+    The rules of a folder are computed once and cached, reading the .gitignore
+    files of the folder and of its parents, up to the repository root: the
+    nearest folder holding a .git, or the top folder given to setTopdir()
+    when it is not in a repository. invalidate() forgets the rules of a
+    folder and of its sub folders when its .gitignore file has changed,
+    clear() forgets them all.
+
+    The rules may be used from several threads.
+
+    To use me:
+    rules = IgnoreRules( [ '.git/', '*.pyc' ] )
+    dirs, files, links = rules.filter( folder, dirs, files, links )
+    '''
+
+    ignoreFileName = '.gitignore'
+    repositoryName = '.git'
+
+    def __init__( self, patterns=(), useIgnoreFiles=True ):
+        self.userGroups = [ ('', group) for group in compilePatterns( patterns ) ]
+        self.useIgnoreFiles = useIgnoreFiles
+        self.root = None
+        self.lock = threading.Lock()
+        self.clear()
+
+    def setTopdir( self, topdir ):
+        '''The tree explored is below topdir: the .gitignore files are read
+        up to the repository root of topdir, or up to topdir itself if it is
+        not in a repository. Return True if the root has changed, the rules
+        are then forgotten.'''
+        root = topdir
+        folder = topdir
+        while 1:
+            if os.path.exists( os.path.join( folder, self.repositoryName ) ):
+                root = folder
+                break
+            parent = os.path.dirname( folder )
+            if parent == folder:
+                break
+            folder = parent
+        if root == self.root:
+            return False
+        self.root = root
+        self.clear()
+        return True
+
+    def clear( self ):
+        '''Forget the rules read from the .gitignore files.'''
+        self.lock.acquire()
+        try:
+            self.folderGroups = {}     # folder -> [ (base, group), ... ]
+            self.stamps = {}           # folder -> mtime of the .gitignore read, or None
+        finally:
+            self.lock.release()
+
+    def invalidate( self, folder ):
+        '''Forget the rules of folder and of its sub folders if its .gitignore
+        file has changed since it was read. Return True if they were
+        forgotten: the listings filtered with them are out of date.'''
+        if folder not in self.folderGroups or not self.useIgnoreFiles:
+            return False
+        if self._stamp( folder ) == self.stamps.get( folder ):
+            return False
+        dbg( 'Rules of %s have changed', folder )
+        prefix = os.path.join( folder, '' )
+        self.lock.acquire()
+        try:
+            for path in self.folderGroups.keys():
+                if path == folder or path.startswith( prefix ):
+                    del self.folderGroups[ path ]
+                    self.stamps.pop( path, None )
+        finally:
+            self.lock.release()
+        return True
+
+    def filter( self, folder, dirs, files, links ):
+        '''Return (dirs, files, links) without the ignored entries of folder.'''
+        groups = self._groupsOf( folder, self.ignoreFileName in files )
+        if not groups:
+            return dirs, files, links
+        dirs = [ name for name in dirs if not self._isIgnored( groups, folder, name, True ) ]
+        files = [ name for name in files if not self._isIgnored( groups, folder, name, False ) ]
+        if links:
+            links = [ name for name in links if name in dirs ]
+        return dirs, files, links
+
+    def isIgnored( self, path, isDir ):
+        '''Return True if the file or folder path is ignored.'''
+        folder, name = os.path.split( path )
+        return self._isIgnored( self._groupsOf( folder ), folder, name, isDir )
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _isIgnored( self, groups, folder, name, isDir ):
+        for base, (negate, fileRegex, dirRegex) in reversed( groups ):
+            if isDir:
+                regex = dirRegex
+            else:
+                regex = fileRegex
+            if regex is None:
+                continue
+            if base:
+                rel = os.path.join( folder, name )[ len( base ) + 1: ]
+                if os.sep != '/':
+                    rel = rel.replace( os.sep, '/' )
+            else:
+                rel = name
+            if regex.match( rel ):
+                return not negate
+        return False
+
+    def _groupsOf( self, folder, hasIgnoreFile=None ):
+        '''Return the rules applying to the content of folder, as a list of
+        (base, group): group applies to the paths relative to the folder
+        base, '' meaning the name of the entry alone.'''
+        groups = self.folderGroups.get( folder )
+        if groups is not None:
+            return groups
+        groups = self.userGroups
+        stamp = None
+        if self.useIgnoreFiles:
+            parent = os.path.dirname( folder )
+            if parent != folder and not self._isRoot( folder ):
+                groups = self._groupsOf( parent )
+            if hasIgnoreFile is None:
+                hasIgnoreFile = os.path.isfile( os.path.join( folder, self.ignoreFileName ) )
+            if hasIgnoreFile:
+                stamp = self._stamp( folder )
+                groups = groups + self._readIgnoreFile( folder )
+        self.lock.acquire()
+        try:
+            self.folderGroups[ folder ] = groups
+            self.stamps[ folder ] = stamp
+        finally:
+            self.lock.release()
+        return groups
+
+    def _isRoot( self, folder ):
+        '''Return True if the rules of the parents of folder do not apply to it.'''
+        if folder == self.root:
+            return True
+        return os.path.exists( os.path.join( folder, self.repositoryName ) )
+
+    def _stamp( self, folder ):
+        try:
+            return os.stat( os.path.join( folder, self.ignoreFileName ) ).st_mtime
+        except OSError:
+            return None
+
+    def _readIgnoreFile( self, folder ):
+        path = os.path.join( folder, self.ignoreFileName )
+        try:
+            f = open( path )
+            try:
+                lines = f.readlines()
+            finally:
+                f.close()
+        except IOError, e:
+            dbg( 'Can not read %s: %s', path, e )
+            return []
+        return [ (folder, group) for group in compilePatterns( lines ) ]
@@ -1,59 +1,540 @@
 # vim:fileencoding=utf-8
 import os
-from vimWrapper import VimWrapper
-from xml.sax.saxutils import escape
+import re
+import time
+import threading
+import Queue
+from vimPool import VimPool
+from dirIndex import DirIndex
+from ignoreRules import IgnoreRules
+from treeScanner import TreeScanner
+from treeModel import TreeModel
+from treeView import TreeView
+from treeOrder import TreeOrder
+from quickOpen import QuickOpenIndex
+from contentSearch import ContentSearch, hitHtml
+from dirWatcher import createDirWatcher
 from const import *
 
 class ExVimFileExplorer:
 
+    # above this number of changed rows in one folder, the content of the
+    # folder is rendered again instead of being patched row by row
+    maxRowDeltas = 200
+
+    # rows are streamed to the table in batches of one fragment, flushed when
+    # they reach batchRows rows or after batchTime seconds. The first batch
+    # is kept to a screenful so that it shows up immediately.
+    firstBatchRows = 50
+    batchRows = 1000
+    batchTime = 0.05
+    # longest wait for the scanner to read the next folder, before handing
+    # the page back
+    scanWait = 0.02
+
+    # the quick-open index is fed by batches of quickBatchFiles files, and
+    # built again from scratch when more than maxQuickFolders folders have
+    # been added to the tree at once
+    quickBatchFiles = 10000
+    maxQuickFolders = 20
+
     def __init__(self):
-        self.vw = VimWrapper(vimExec = vimExec)
-        self.vw.start()
+        self.vims = VimPool(vimExec = vimExec, mirrorBuffers = mirrorBuffers, size = vimInstances)
+        # Vim starts while the tree is listed, the files opened meanwhile
+        # are opened once it is ready
+        self.vims.startAsync()
+        self.lazy = lazyListup
+        self.virtual = virtualRows
+        self.ignore = IgnoreRules(ignorePatterns, useGitignore)
+        self.index = DirIndex(ignore=self.ignore)
+        self.watcher = createDirWatcher()
+        self.model = TreeModel()
+        self.model.setOrder(TreeOrder(treeOrder))
+        self.view = TreeView(self.model)
+        self.rowStream = None
+        self.batchSize = self.firstBatchRows
+        self.generation = 0
+        self.rowCount = 0
+        self.quickIndex = QuickOpenIndex()
+        self.quickGeneration = 0
+        self._resetQuickIndex(None)
+        self.contentSearch = ContentSearch(self.index)
         curdir = os.getcwd()
         jQuery('#targetPath').val(curdir)
+        jQuery('#order').val(treeOrder)
 
     def listup(self, topdir):
+        '''List topdir. The listing replaces the running one, which is
+        cancelled. Return the generation of the listing, to give to
+        renderBatch().'''
         if not os.path.isdir(topdir):
-            return
-        i = 0
-        tree = {}
-        rows = []
-        for root, dirs, files in os.walk(topdir, topdown=True):
-            for dir_ in dirs:
-                i = i + 1
-                node = 'node-' + str(i)
-                full_path = os.path.join(root, dir_)
-                parent = ''
-                if root in tree:
-                    parent = ' class="child-of-' + tree[root] + '"'
-                rows.append([ full_path, '<tr id="' + node + '"' + parent + '>' \
-                    + '<td><span class="folder" title="' + escape(full_path) \
-                    + '">' + escape(dir_) + '</td>' \
-                    + '</tr>' ]);
-                tree[full_path] = node
-            for file_ in files:
-                i = i + 1
-                node = 'node-' + str(i)
-                full_path = os.path.join(root, file_)
-                mod_path = os.path.join(root, '|' + file_)
-                parent = ''
-                if root in tree:
-                    parent = ' class="child-of-' + tree[root] + '"'
-                rows.append([ mod_path, '<tr id="' + node + '"' + parent + '>' \
-                    + '<td><span class="file" title="' + escape(full_path) \
-                    + '">' + escape(file_) + '</td>' \
-                    + '</tr>' ]);
-        rows.sort()
+            return self.generation
+        self._reset(topdir)
+        self._resetQuickIndex(topdir)
+        if self.virtual:
+            self.listupVirtual(topdir)
+            return self.generation
+        if self.lazy:
+            self.listupLazy(topdir)
+            return self.generation
         table = jQuery('#result').empty()
-        parent_dir = os.path.realpath(topdir + '/..')
-        table.append('<tr id="node-0"><td><span class="folder" title="' \
-            + parent_dir + '">..</span></td></tr>')
-        for path, row in rows:
-            table.append(row)
+        table.append(self._parentRow())
+        self._startListing(self._streamRows(topdir))
+        return self.generation
+
+    def renderBatch(self, generation):
+        '''Append the next batch of rows of the listing generation to the
+        table, as a single fragment. Return True while rows remain, False
+        when the listing is done or has been replaced by another one.
+
+        The call does not wait for the disk: when the next folder has not
+        been read yet, the batch ends there and True is returned.'''
+        if generation != self.generation or not self.rowStream:
+            return False
+        nodes = []
+        start = time.time()
+        for node in self.rowStream:
+            if node is None:
+                # the next folder is still being read
+                break
+            nodes.append(node)
+            if len(nodes) >= self.batchSize or time.time() - start > self.batchTime:
+                break
+        else:
+            self.rowStream = None
+        if nodes:
+            appendRows(''.join([ self.model.rowHtml(node) for node in nodes ]))
+        self.rowCount += len(nodes)
+        self.batchSize = self.batchRows
+        return self.rowStream is not None
+
+    def progress(self):
+        '''Return the progress of the current listing, as a message.'''
+        if self.rowStream:
+            return 'Listing... %d entries' % self.rowCount
+        return '%d entries' % self.rowCount
+
+    def listupLazy(self, topdir):
+        '''List only the immediate children of topdir. The content of a
+        folder is fetched with listChildren() when its row is expanded.'''
+        table = jQuery('#result').empty()
+        table.append(self._parentRow())
+        table.append(self.listChildren(topdir))
+
+    def setOrder(self, name):
+        '''Change the order of the entries of the folders: name, natural,
+        extension, size or mtime. Only the loaded folders are sorted again,
+        the disk is not read. Return the generation of the new listing.'''
+        self._stopListing()
+        self.model.setOrder(TreeOrder(name))
+        if self.virtual:
+            self.view.rebuild()
+            return self.generation
+        table = jQuery('#result').empty()
+        table.append(self._parentRow())
+        self._startListing(self.model.walkNodes())
+        return self.generation
+
+    def listupVirtual(self, topdir):
+        '''List topdir in virtual mode: the page only renders the rows in its
+        viewport, asking for them with rowSlice(). Folders are loaded when
+        they are expanded with toggleRow().'''
+        self._loadFolder(0, topdir)
+        self.view.reset()
+
+    def isVirtual(self):
+        return self.virtual
+
+    def rowNb(self):
+        '''Return the number of rows in virtual mode, ".." included.'''
+        return self.view.rowNb() + 1
+
+    def rowSlice(self, start, count):
+        '''Return the rows start to start+count in virtual mode, as a single
+        HTML fragment. Row 0 is "..", row i is the visible row i-1 of the view.'''
+        rows = []
+        if start == 0:
+            rows.append(self._parentRow())
+            count = count - 1
+        else:
+            start = start - 1
+        rows.append(self.view.rowsHtml(start, count))
+        return ''.join(rows)
+
+    def toggleRow(self, index):
+        '''Expand or collapse the folder at the visible row index of the
+        view, loading its content first if needed.'''
+        node = self.view.node(index)
+        if self.model.isFile(node):
+            return
+        if not self.model.isLoaded(node):
+            self._loadFolder(node, self.model.path(node))
+        elif not self.view.isExpanded(node):
+            self.folderExpanded(self.model.path(node))
+        self.view.toggle(index)
+
+    def folderExpanded(self, path):
+        '''Watch the loaded folder path, expanded in the page. Its content is
+        read again first: it was not watched while its rows were hidden.'''
+        node = self.model.folder(path)
+        if node is None or not self.model.isLoaded(node) or self.watcher.isWatched(path):
+            return
+        self.index.invalidate(path)
+        self._refreshChildren(node, path)
+        self.watcher.watch(path)
+
+    def listChildren(self, path):
+        '''Return the rows of the immediate children of the displayed folder
+        path as a single HTML fragment, folders first.
+
+        Sub folders are not loaded: treeTable draws an expander for them and
+        their content is fetched when they are expanded.
+        '''
+        node = self.model.folder(path)
+        if node is None or self.model.isLoaded(node):
+            return ''
+        kids = self._loadFolder(node, path)
+        return ''.join([ self.model.rowHtml(kid) for kid in kids ])
+
+    def quickOpen(self, query):
+        '''Return the files of the tree best matching query, as <li> items.
+        The whole tree under the top folder is searched, whatever is displayed.
+
+        The files are indexed on the first call, in the background: the
+        results grow as the index is built.'''
+        if self.quickTopdir is None:
+            return ''
+        if not self.quickStarted:
+            self._startQuickIndex()
+        return self.quickIndex.resultsHtml(query)
+
+    def search(self, path, pattern):
+        '''Start searching the files under the folder path for the regular
+        expression pattern, in the background: the hits are fetched with
+        searchHits(). Return an error message, or '' if the search started.'''
+        if not os.path.isdir(path):
+            path = self.model.topdir
+        try:
+            self.contentSearch.start(path, pattern)
+        except re.error, e:
+            return 'Invalid pattern: %s' % e
+        return ''
+
+    def isSearching(self):
+        return self.contentSearch.isRunning()
+
+    def searchHits(self):
+        '''Return the hits found since the last call as <li> items, holding
+        the path, line and column of the hit.'''
+        return ''.join([ hitHtml(*hit) for hit in self.contentSearch.takeHits() ])
+
+    def openHit(self, path, line, col):
+        '''Open the file path in Vim, the cursor on the hit at line, col.'''
+        if not os.path.exists(path):
+            return
+        self.vims.whenReady(self._openHit, path, line, col)
+
+    def _openHit(self, path, line, col):
+        vw, bufId = self.vims.openFile(path)
+        vw.mirrorBuffer(bufId)
+        vw.setCurrentBufferLineCol(bufId, int(line), int(col))
+
+    def pollChanges(self):
+        '''Apply the changes made on disk to the displayed folders, as row
+        insertions and removals. Return True if the tree has changed.'''
+        changed = False
+        for path in self.watcher.readChanges():
+            node = self.model.folder(path)
+            if node is None or not self.model.isLoaded(node):
+                # not displayed anymore
+                continue
+            self.index.invalidate(path)
+            if self.ignore.invalidate(path):
+                # its .gitignore has changed: the folders below it were
+                # filtered with the old rules
+                changed = self._refreshTree(node, path) or changed
+            else:
+                changed = self._refreshChildren(node, path) or changed
+        self._flushQuickIndex()
+        if self.vims.isReady():
+            # drops the Vim which have been closed
+            self.vims.processVimEvents()
+        if changed and self.virtual:
+            self.view.rebuild()
+        return changed
+
+    def _streamRows(self, topdir):
+        '''Generate the nodes of the tree under topdir in display order, as
+        the scanner reads the folders: each folder is followed by its content,
+        folders first.
+
+        The folders are read in a background thread: None is generated while
+        the next folder has not been read yet, instead of waiting for it.'''
+        # the folders below are watched when they are expanded
+        self.watcher.watch(topdir)
+        results = Queue.Queue()
+        stop = threading.Event()
+        thread = threading.Thread(target=self._scan, args=(topdir, results, stop))
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            peek = [ None ]
+            for waiting in self._fetch(results, peek):
+                yield None
+            if peek[0]:
+                for node in self._streamChildren(0, results, peek):
+                    yield node
+        finally:
+            # stops the scan when the listing is cancelled
+            stop.set()
+
+    def _scan(self, topdir, results, stop):
+        '''Put the (root, dirs, files) of the walk of topdir in results, then
+        None, unless stop gets set first.'''
+        walker = TreeScanner(self.index, self.model.order).walk(topdir)
+        try:
+            for item in walker:
+                if stop.isSet():
+                    return
+                results.put(item)
+        finally:
+            walker.close()
+            results.put(None)
+
+    def _fetch(self, results, peek):
+        '''Put the next folder of the walk in peek[0], None at the end of the
+        walk. Generate None while it has not been read.'''
+        while 1:
+            try:
+                peek[0] = results.get(True, self.scanWait)
+                return
+            except Queue.Empty:
+                yield None
+
+    def _streamChildren(self, node, results, peek):
+        root, dirs, files = peek[0]
+        for waiting in self._fetch(results, peek):
+            yield None
+        for kid in self._loadChildren(node, root, dirs, files):
+            if self.model.isFile(kid):
+                yield kid
+            elif peek[0] and peek[0][0] == os.path.join(root, self.model.name(kid)):
+                # the row of a folder depends on its content: load it before
+                # handing out the row
+                content = self._streamChildren(kid, results, peek)
+                first = None
+                for first in content:
+                    if first is not None:
+                        break
+                    yield None
+                yield kid
+                if first is not None:
+                    yield first
+                    for node in content:
+                        yield node
+            else:
+                # symbolic link or unreadable folder
+                yield kid
+
+    def _parentRow(self):
+        '''Return the ".." row, leading to the parent of the top folder.'''
+        parent_dir = os.path.realpath(self.model.topdir + '/..')
+        return '<tr id="node-0"><td><span class="folder" title="' \
+            + parent_dir + '">..</span></td></tr>'
+
+    def _reset(self, topdir):
+        self._stopListing()
+        self.watcher.unwatchAll()
+        self.model.reset(topdir)
+        if self.ignore.setTopdir(topdir):
+            # the listings were filtered with the rules of another repository
+            self.index.clear()
+
+    def _startListing(self, stream):
+        '''Stream the rows of stream to the table with renderBatch().'''
+        self.rowStream = stream
+        self.rowCount = 0
+        self.batchSize = self.firstBatchRows
+
+    def _stopListing(self):
+        '''Cancel the current listing, the next one gets a new generation.'''
+        if self.rowStream:
+            self.rowStream.close()
+            self.rowStream = None
+        self.rowCount = 0
+        self.generation += 1
+
+    def _resetQuickIndex(self, topdir):
+        '''Empty the quick-open index. It is built for topdir on the next
+        quick-open.'''
+        self.quickGeneration += 1
+        self.quickTopdir = topdir
+        self.quickStarted = False
+        self.quickFolders = []      # added folders, not indexed yet
+        self.quickRebuild = False   # too many changes, index everything again
+        self.quickIndex.clear(topdir or '')
+
+    def _startQuickIndex(self):
+        '''Index the files under the top folder, in the background.'''
+        self._resetQuickIndex(self.quickTopdir)
+        self.quickStarted = True
+        self._indexFolders([ self.quickTopdir ])
+
+    def _indexFolders(self, paths):
+        '''Index the files under the folders paths, in one background walk.'''
+        thread = threading.Thread(target=self._quickIndexer,
+            args=(paths, self.quickGeneration))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _quickIndexer(self, paths, generation):
+        files = []
+        for path in paths:
+            for root, dirs, names in TreeScanner(self.index).walk(path):
+                if generation != self.quickGeneration:
+                    # another folder is listed
+                    return
+                files.extend([ os.path.join(root, name) for name in names ])
+                if len(files) >= self.quickBatchFiles:
+                    self.quickIndex.addFiles(files)
+                    files = []
+        if generation == self.quickGeneration:
+            self.quickIndex.addFiles(files)
+
+    def _updateQuickIndex(self, path, removed, added):
+        '''Apply the changes of the folder path to the quick-open index. The
+        added folders are indexed by _flushQuickIndex().'''
+        if not self.quickStarted or self.quickRebuild:
+            return
+        if len(removed) + len(added) > self.maxRowDeltas:
+            self.quickRebuild = True
+            return
+        files = []
+        for kid in removed:
+            if self.model.isFile(kid):
+                files.append(self.model.path(kid))
+            else:
+                self.quickIndex.removeFolder(self.model.path(kid))
+        self.quickIndex.removeFiles(files)
+        self.quickIndex.addFiles([ os.path.join(path, name)
+            for isFile, name in added if isFile ])
+        self.quickFolders.extend([ os.path.join(path, name)
+            for isFile, name in added if not isFile ])
+
+    def _flushQuickIndex(self):
+        '''Index the folders added since the last call in a single walk, or
+        the whole tree again after too many changes.'''
+        if not self.quickStarted:
+            return
+        if self.quickRebuild or len(self.quickFolders) > self.maxQuickFolders:
+            self._startQuickIndex()
+        elif self.quickFolders:
+            self._indexFolders(self.quickFolders)
+            self.quickFolders = []
+
+    def _loadFolder(self, node, path):
+        '''Read the folder node, displayed or expanded, load its content in
+        the model and watch it.'''
+        try:
+            dirs, files = self.index.listDir(path)
+        except OSError:
+            dirs, files = [], []
+        self.watcher.watch(path)
+        order = self.model.order
+        return self._loadChildren(node, path, order.sort(path, dirs), order.sort(path, files))
+
+    def _loadChildren(self, node, path, dirs, files):
+        '''Load the content of the folder node in the model.'''
+        return self.model.setChildren(node, dirs, files)
+
+    def _refreshChildren(self, node, path):
+        try:
+            dirs, files = self.index.listDir(path)
+        except OSError:
+            # the folder is gone, the change is handled with its parent
+            return
+        model = self.model
+        kids = model.children(node)
+        old = [ model.entry(kid) for kid in kids ]
+        new = [ (False, dir_) for dir_ in dirs ] + [ (True, file_) for file_ in files ]
+        newSet = set(new)
+        removed = [ kid for kid, entry in zip(kids, old) if entry not in newSet ]
+        oldSet = set(old)
+        added = [ entry for entry in new if entry not in oldSet ]
+        if not removed and not added:
+            return False
+        self._updateQuickIndex(path, removed, added)
+
+        if self.virtual:
+            # the rows are rendered from the model by the page
+            for kid in removed:
+                self._removeRows(model.removeChild(node, kid))
+            for isFile, name in added:
+                model.insertChild(node, name, isFile)
+            return True
+
+        if len(removed) + len(added) > self.maxRowDeltas:
+            self._removeRows(model.clearChildren(node))
+            attachRows(self._rowId(node), self._parentId(node),
+                self.listChildren(path))
+            return True
+
+        for kid in removed:
+            self._removeRows(model.removeChild(node, kid))
+        for isFile, name in added:
+            kid, pos = model.insertChild(node, name, isFile)
+            if pos:
+                anchor = model.lastDescendant(model.children(node)[pos - 1])
+            else:
+                anchor = node
+            attachRows(self._rowId(anchor), self._parentId(node), model.rowHtml(kid))
+        return True
+
+    def _refreshTree(self, node, path):
+        '''Read again the folder node and the loaded folders below it.'''
+        self.index.invalidateTree(path)
+        if self.quickStarted:
+            self.quickRebuild = True
+        changed = self._refreshChildren(node, path)
+        for kid in list(self.model.walkNodes(node)):
+            if not self.model.isLoaded(kid):
+                continue
+            changed = self._refreshChildren(kid, self.model.path(kid)) or changed
+        return changed
+
+    def _removeRows(self, removed):
+        nodes, folders = removed
+        for path in folders:
+            self.watcher.unwatch(path)
+        if nodes:
+            jQuery(', '.join([ '#node-%d' % node for node in nodes ])).remove()
+
+    def _rowId(self, node):
+        # the top folder has no row of its own, its content follows the ".." row
+        return 'node-%d' % node
+
+    def _parentId(self, node):
+        if node == 0:
+            return ''
+        return 'node-%d' % node
+
+    def loadFiles(self, paths):
+        '''Open the files of paths, given one per line, in a single burst.'''
+        paths = [ path for path in paths.split('\n') if os.path.isfile(path) ]
+        if not paths:
+            return
+        self.vims.whenReady(self._loadFiles, paths)
+
+    def _loadFiles(self, paths):
+        for vw, bufIds in self.vims.openFiles(paths):
+            vw.mirrorBufferList(bufIds)
 
     def loadFile(self, path):
         if not os.path.exists(path):
             return
-        bufId = self.vw.openFile(path)
-        self.vw.server.sendCmd(bufId, 'stopDocumentListen', True)
+        self.vims.whenReady(self._loadFile, path)
+
+    def _loadFile(self, path):
+        vw, bufId = self.vims.openFile(path)
+        vw.mirrorBuffer(bufId)
 
@@ -1,6 +1,8 @@
 
 from logSystem import *
 import socket
+import select
+import errno
 import random
 
 dbg = getLogger('MyTcpServer').debug
@@ -13,12 +15,20 @@ class MyTcpServer:
     request_queue_size = 5
     allow_reuse_address = False
 
+    # initial size of the receive buffer. It grows to hold the longest line,
+    # and is dropped back to this size when it holds more than maxIdleSize
+    # bytes and is emptied.
+    recvSize = 65536
+    maxIdleSize = 1024 * 1024
+    freeSpace = bytearray( recvSize )     # appended to grow the buffer
+
     def __init__( self, port ):
         self.port = port
         self.socket = None
-        self.rfile = None
+        self.conn = None
         self.wfile = None
         self.connected = False
+        self._resetBuffer()
 
     def startServer( self ):
         dbg('Starting server on port %d' % self.port)
@@ -27,7 +37,7 @@ class MyTcpServer:
 
         except Exception, e:
             dbg('Start failed.')
-            if string.find(str(e), "ddress already in use") >= 0:
+            if str(e).find("ddress already in use") >= 0:
 
                 # Port number already in use, retry with another port number.
                 random.seed()
@@ -43,20 +53,133 @@ class MyTcpServer:
         '''Wait until a connection has been made.'''
         self._acceptRequest()
 
+    def acceptConnection( self, timeout=None ):
+        '''Wait at most timeout seconds, forever if timeout is None, for a
+        connection on the listening socket. Return the connected socket, or
+        None if no connection came in time.
+
+        The connection is not used by this server: it is given to another
+        one with useConnection(), so that one listening socket may serve
+        several clients.
+        '''
+        while 1:
+            try:
+                readable = select.select( [ self.socket ], [], [], timeout )[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                return None
+            conn, addr = self.socket.accept()
+            dbg( 'Connection from %s', str( addr ) )
+            return conn
+
+    def useConnection( self, conn ):
+        '''Read and write through the connected socket conn, accepted by
+        another server.'''
+        self.conn = conn
+        self.connected = True
+        self._resetBuffer()
+
+        wbufsize = 0    # unbuffered for write
+        self.wfile = self.conn.makefile('wb', wbufsize)
+
     def closeServer(self):
         self.connected = False
-        self.socket.close()
-        if self.rfile: self.rfile.close()
+        if self.socket: self.socket.close()
         if self.wfile: self.wfile.close()
-        self.rfile = None
+        if self.conn: self.conn.close()
+        self.conn = None
         self.wfile = None
+        self._resetBuffer()
 
     def isConnected( self ): return self.connected
 
+    def readLine( self, timeout=None ):
+        '''Return the next line received, without its end of line.
+
+        Wait at most timeout seconds for the line to be complete, forever if
+        timeout is None. The call returns as soon as the line is received,
+        select() waking up on the arrival of data.
+
+        Return an empty line if no line was received in time, or if the
+        connection has been closed: isConnected() is then False.
+
+        The data is received in a growable bytearray, in which the lines are
+        found in place: each line is copied only once, when it is returned.
+        '''
+        while 1:
+            eol = self.rbuf.find( '\n', self.rbufScanned, self.rbufEnd )
+            if eol >= 0:
+                # the line is copied once, from the buffer
+                line = memoryview( self.rbuf )[ self.rbufStart:eol ].tobytes()
+                self.rbufStart = self.rbufScanned = eol + 1
+                return line
+            self.rbufScanned = self.rbufEnd
+
+            if self.conn is None:
+                return ''
+            try:
+                readable = select.select( [ self.conn ], [], [], timeout )[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                err( 'Select error on socket: %s' % str( e ) )
+                self.connected = False
+                return ''
+            if not readable:
+                # no complete line in time
+                return ''
+            self._makeRoom()
+            try:
+                nbytes = self.conn.recv_into( memoryview( self.rbuf )[ self.rbufEnd: ] )
+            except socket.error, e:
+                if e.args[0] in (errno.EINTR, errno.EWOULDBLOCK, errno.EAGAIN):
+                    continue
+                err( 'Read error from socket: %s' % str( e ) )
+                self.connected = False
+                return ''
+            if not nbytes:
+                # connection closed
+                self.connected = False
+                return ''
+            self.rbufEnd += nbytes
+
     #######################################################################
     #                         Private API
     #######################################################################
 
+    def _resetBuffer( self ):
+        # received data is read straight into rbuf. rbuf[rbufStart:rbufEnd]
+        # has not been returned as lines yet, and holds no end of line before
+        # rbufScanned.
+        self.rbuf = bytearray( self.recvSize )
+        self.rbufStart = 0
+        self.rbufEnd = 0
+        self.rbufScanned = 0
+
+    def _makeRoom( self ):
+        '''Make room at the end of rbuf for the next read.'''
+        if self.rbufStart == self.rbufEnd:
+            # everything has been returned
+            if len( self.rbuf ) > self.maxIdleSize:
+                self._resetBuffer()
+            self.rbufStart = self.rbufEnd = self.rbufScanned = 0
+        if len( self.rbuf ) - self.rbufEnd >= self.recvSize / 2:
+            return
+        pending = self.rbufEnd - self.rbufStart
+        if pending <= len( self.rbuf ) / 2:
+            # move the pending data to the front
+            self.rbuf[ :pending ] = self.rbuf[ self.rbufStart:self.rbufEnd ]
+            self.rbufScanned -= self.rbufStart
+            self.rbufStart = 0
+            self.rbufEnd = pending
+        else:
+            # bytearray over-allocates when it grows, so that growing it by
+            # small steps is amortized linear, without a temporary copy
+            self.rbuf.extend( self.freeSpace )
+
     def _startSocket( self ):
         if self.socket: self.socket.close()
         self.socket = socket.socket(self.address_family, self.socket_type)
@@ -68,20 +191,56 @@ class MyTcpServer:
     def _acceptRequest(self):
         '''Block until the a request is received.
 
-        After the connection is accepted, rfile and wfile are file-like objects to read from the
-        socket and write to the socket.
-
-        The socket is put in non-blocking mode.
+        After the connection is accepted, lines are read with readLine() and
+        wfile is a file-like object to write to the socket.
         '''
-        (self.conn, addr) =  self.socket.accept()
-        self.conn.settimeout( 0.2 ) # 0.2 s
-        self.connected = True
-
-        rbufsize = -1   # buffered for read
-        self.rfile = self.conn.makefile('rb', rbufsize)
-
-        wbufsize = 0    # unbuffered for write
-        self.wfile = self.conn.makefile('wb', wbufsize)
-
-
-
+        (conn, addr) =  self.socket.accept()
+        self.useConnection( conn )
+
+
+
+
+
+def _benchmark( size=100*1024*1024, maxGrowth=3 ):
+    '''Stream a line of size bytes to the server and read it back with
+    readLine(), reporting the time taken and the growth of the peak memory.
+
+    Fail if the line is not read back whole, or if the peak memory grows by
+    more than maxGrowth times the size of the line: the chunks received and
+    the line joined from them, with some slack.'''
+    import threading, time, resource
+
+    server = MyTcpServer( 0 )
+    server._startSocket()
+    port = server.socket.getsockname()[1]
+    chunk = 'x' * (1024 * 1024)
+
+    def sender():
+        conn = socket.create_connection( ('127.0.0.1', port) )
+        sent = 0
+        while sent < size:
+            conn.sendall( chunk[ :size - sent ] )
+            sent += len( chunk )
+        conn.sendall( '\nshort line\n' )
+        conn.close()
+
+    t = threading.Thread( target=sender )
+    t.setDaemon( True )
+    t.start()
+    server.waitForConnection()
+    peak = resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss
+    start = time.time()
+    line = server.readLine()
+    duration = time.time() - start
+    # ru_maxrss is in KB
+    growth = (resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss - peak) * 1024
+    assert len( line ) == size and line == chunk * (size / len( chunk )) + chunk[ :size % len( chunk ) ]
+    assert server.readLine() == 'short line'
+    assert server.readLine() == ''
+    print '%d MB line read in %.3f s, peak memory grown by %d MB' % (
+        size / 1024 / 1024, duration, growth / 1024 / 1024)
+    server.closeServer()
+    assert growth <= maxGrowth * size, 'peak memory grown by %d MB' % (growth / 1024 / 1024)
+
+if __name__ == '__main__':
+    _benchmark()
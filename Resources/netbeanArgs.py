@@ -17,6 +17,52 @@ argDescReDict = {
     'OPTMSG': reOptMsg,
 }
 
+def _optNum( argVal ):
+    if argVal == 'none':
+        return None
+    return int( argVal )
+
+def _pos( argVal ):
+    return tuple( [ int(i) for i in argVal.split('/') ] )
+
+def _bool( argVal ):
+    return { 'T':True, 'F':False }[ argVal ]
+
+def _identity( argVal ):
+    return argVal
+
+argDescConvDict = {
+    'STR': lambda argVal: simplifyBackslash( argVal ),
+    'PATH': lambda argVal: simplifyBackslash( argVal ),
+    'NUM': int,
+    'OPTNUM': _optNum,
+    'POS':  _pos,
+    'BOOL': _bool,
+    'OPTMSG': _identity,
+}
+
+# argDesc -> (compiled regex, tuple of converters)
+argParserCache = {}
+
+def compileArgDesc( argDesc ):
+    '''Return the parser of argDesc, see parseNetbeanArgs(): a compiled regex
+    matching the reply and the tuple of the converters of its groups.
+
+    Parsers are compiled once per argDesc and cached.
+    '''
+    parser = argParserCache.get( argDesc )
+    if parser is None:
+        try:
+            argDescList = argDesc.split(' ')
+            argDescReList = [ argDescReDict[i] for i in argDescList ]
+            converters = tuple( [ argDescConvDict[i] for i in argDescList ] )
+        except KeyError:
+            raise ValueError( 'TypeError, wrongly formatted argument list: %s' % argDesc )
+        reArg = re.compile( ' '.join( argDescReList) + '$' )
+        parser = (reArg, converters)
+        argParserCache[ argDesc ] = parser
+    return parser
+
 def parseNetbeanArgs( netbeanArgs, argDesc ):
     '''Parse a netbean reply string netbeanArgs according to argDesc and return a tuple containing
     the parse results.
@@ -32,76 +78,50 @@ def parseNetbeanArgs( netbeanArgs, argDesc ):
     BOOL    --> a boolean
     OPTMSG  --> None or a string
     '''
-    try:
-        argDescList = argDesc.split(' ')
-        argDescReList = [ argDescReDict[i] for i in argDescList ]
-        reArg = re.compile( ' '.join( argDescReList) + '$' )
-        mo = reArg.match( netbeanArgs )
-        if not mo:
-            raise ValueError( 'TypeError, could not match netbeanArgs \'%s\' with re \'%s\'' % (netbeanArgs, reArg.pattern) )
-        ret = []
-        # dbg( 'mo=%s', str(mo.groups()) )
-        for argType, argVal in zip( argDescList, mo.groups()[0:] ):
-            if   argType == 'STR'    : ret.append( simplifyBackslash( argVal ) )
-            elif argType == 'PATH'   : ret.append( simplifyBackslash( argVal ) ) 
-            elif argType == 'NUM'    : ret.append( int(argVal) )
-            elif argType == 'OPTNUM' : ret.append( None if argVal =='none' else int(argVal) )
-            elif argType == 'POS' : ret.append( tuple( [ int(i) for i in argVal.split('/') ] ) )
-            elif argType == 'BOOL' : ret.append( { 'T':True, 'F':False }[ argVal] )
-            elif argType == 'OPTMSG' : ret.append( argVal )
-            else:
-                raise ValueError( 'Can not grok type \'%s\' for argument \'%s\'' % (argType, argVal) )
-        return tuple(ret)
-        
-    except KeyError:
-        raise ValueError( 'TypeError, wrongly formatted argument list: %s' % argDesc )
+    reArg, converters = compileArgDesc( argDesc )
+    mo = reArg.match( netbeanArgs )
+    if not mo:
+        raise ValueError( 'TypeError, could not match netbeanArgs \'%s\' with re \'%s\'' % (netbeanArgs, reArg.pattern) )
+    return tuple( [ conv( argVal ) for conv, argVal in zip( converters, mo.groups() ) ] )
+
+unescapeList = [ ('\\n', '\n'), ('\\t', '\t'), ('\\r', '\r'), ('\\"', '"') ]
 
 def simplifyBackslash( s ):
-    r'''Return s with \" \n \t \\ converted into single char.'''
-    l = list(s)
-    i = 0
-    while i < len(l)-1:
-        if l[i] == '\\':
-            if l[i+1] == '\\': l[i:i+2] = '\\'
-            elif l[i+1] == 'n': l[i:i+2] = '\n'
-            elif l[i+1] == 't': l[i:i+2] = '\t'
-            elif l[i+1] == 'r': l[i:i+2] = '\r'
-            elif l[i+1] == '"': l[i:i+2] = '"'
-            else: raise ValueError( 'Unknown escape sequence: %s' % str(l[i:i+2]) )
-        i += 1
-    s = ''.join(l)
+    r'''Return s with \" \n \t \\ converted into single char.
+
+    Runs in linear time: the \\ pairs are set apart, then the other sequences
+    are replaced. A backslash left is an unknown escape sequence, except at
+    the very end of s.'''
+    if '\\' not in s:
+        return s
+    if '\0' in s:
+        # no placeholder for the \\ pairs: unescape between them
+        parts = s.split( '\\\\' )
+        for i, part in enumerate( parts ):
+            if '\\' in part:
+                parts[i] = _unescapePart( part, i == len( parts ) - 1 )
+        return '\\'.join( parts )
+    s = _unescapePart( s.replace( '\\\\', '\0' ), True )
+    return s.replace( '\0', '\\' )
+
+def _unescapePart( s, isLast ):
+    for seq, char in unescapeList:
+        if seq in s:
+            s = s.replace( seq, char )
+    pos = s.find( '\\' )
+    if pos >= 0 and not (isLast and pos == len( s ) - 1):
+        raise ValueError( 'Unknown escape sequence: %s' % str( list( s[ pos:pos+2 ] ) ) )
     return s
 
+escapeList = [ ('\\', '\\\\'), ('\n', '\\n'), ('\t', '\\t'), ('\r', '\\r'), ('"', '\\"') ]
+
 def backslashEscape( s ):
     r'''Return s with characters \ \n \t \r " espcaped with a \ '''
-    l = list(s)
-    i = 0
-    while i < len(l):
-        if l[i] == '\\': 
-            l[i:i+1] = ['\\', '\\' ]
-            i += 2
-            continue
-        elif l[i] == '\n': 
-            l[i:i+1] = ['\\', 'n' ]
-            i += 2
-            continue
-        elif l[i] == '\t': 
-            l[i:i+1] = ['\\', 't' ]
-            i += 2
-            continue
-        elif l[i] == '\r': 
-            l[i:i+1] = ['\\', 'r' ]
-            i += 2
-            continue
-        elif l[i] == '"': 
-            l[i:i+1] = ['\\', '"' ]
-            i += 2
-            continue
-        i += 1
-    s = ''.join(l)
+    # the backslashes first, the other replacements add backslashes
+    for char, seq in escapeList:
+        if char in s:
+            s = s.replace( char, seq )
     return s
-        
-    
 
 def packArgs( *args ):
     '''Return all the argument converted into netbean format, as a string.
@@ -130,6 +150,54 @@ def packArgs( *args ):
     # add space if list is not empty
     if len(retList): retList.insert( 0, '' )
     return ' '.join( retList )
-    
-    
 
+
+def _benchmark( n=100000 ):
+    '''Time the parsing of typical replies, with and without the parser cache.'''
+    import time
+    replies = [
+        ('1 2 3 4', 'NUM NUM NUM NUM'),
+        ('"/tmp/some file.txt" T F', 'STR BOOL BOOL'),
+        ('"x" 12 3/4', 'STR NUM POS'),
+        ('none', 'OPTNUM'),
+    ]
+    for netbeanArgs, argDesc in replies:
+        t = time.time()
+        for i in range( n ):
+            parseNetbeanArgs( netbeanArgs, argDesc )
+        tCached = time.time() - t
+        t = time.time()
+        for i in range( n ):
+            argParserCache.clear()
+            parseNetbeanArgs( netbeanArgs, argDesc )
+        tUncached = time.time() - t
+        print '%-16s cached: %5.2f us/reply, compiled per reply: %5.2f us/reply' % (
+            argDesc, tCached / n * 1e6, tUncached / n * 1e6)
+
+def _checkCodecs():
+    '''Time backslashEscape() and simplifyBackslash() on payloads of 1 KB,
+    1 MB and 50 MB full of characters to escape. Fail if a payload does not
+    come back unchanged, or if the time per MB grows with the size: the
+    codecs must stay linear.'''
+    import time
+    unit = 'line\twith "quotes" and \\ backslash\r\n'
+    assert backslashEscape( unit ) == 'line\\twith \\"quotes\\" and \\\\ backslash\\r\\n'
+    perMB = {}
+    for size in (1024, 1024*1024, 50*1024*1024):
+        text = (unit * (size / len( unit ) + 1))[ :size ]
+        t = time.time()
+        escaped = backslashEscape( text )
+        tEscape = time.time() - t
+        t = time.time()
+        back = simplifyBackslash( escaped )
+        tUnescape = time.time() - t
+        assert back == text
+        print '%9d bytes: escape %8.4f s (%6.3f s/MB), unescape %8.4f s (%6.3f s/MB)' % (
+            size, tEscape, tEscape * 1024 * 1024 / size, tUnescape, tUnescape * 1024 * 1024 / size)
+        perMB[ size ] = (tEscape + tUnescape) * 1024 * 1024 / size
+    # 1 KB is too short to be timed
+    assert perMB[ 50*1024*1024 ] <= 3 * perMB[ 1024*1024 ], 'codecs slower per MB on 50 MB than on 1 MB'
+
+if __name__ == '__main__':
+    _benchmark()
+    _checkCodecs()
@@ -1,7 +1,7 @@
 
 from   logSystem import *
 from   netbeanArgs import *
-import random, errno, re
+import random, re, socket, time
 
 from myTcpServer import *
 
@@ -13,6 +13,37 @@ NETBEAN_PORT = 5678
 class NetbeanProtocolError(Exception): pass
 
 
+class NetbeanReply:
+    '''The pending reply to a request sent to Vim.
+
+    The reply is received when the server processes the incoming lines:
+    result() processes them until the reply is there, and returns it parsed
+    with the reply format of the request.
+    '''
+
+    def __init__( self, server, seqId, replyFmt=None ):
+        self.server = server
+        self.seqId = seqId
+        self.replyFmt = replyFmt
+        self.done = False
+        self.value = None
+
+    def set( self, args ):
+        self.value = args
+        self.done = True
+
+    def result( self ):
+        '''Wait for the reply and return it: the reply string, or the tuple
+        of arguments parsed with the reply format.'''
+        self.server.waitReply( self )
+        if self.replyFmt is None:
+            return self.value
+        try:
+            return parseNetbeanArgs( self.value, self.replyFmt )
+        except ValueError:
+            raise NetbeanProtocolError( 'Unexpected response format: %s for format %s' % (self.value, self.replyFmt ) )
+
+
 
 class NetbeanServer( MyTcpServer ):
     '''Class to handle the netbean protocol.
@@ -36,6 +67,18 @@ class NetbeanServer( MyTcpServer ):
         netbean.processRequest()
 
     netbean.closeServer()
+
+    Requests are pipelined: several requests can be sent with sendRequest()
+    before their replies are collected.
+
+    Commands sent between startBatch() and endBatch() are queued and written
+    to the socket at once. The queue is flushed before blocking on a read.
+
+    A server may also be a session of a client accepted by another server,
+    when several Vim connect to a single listening socket (see VimPool): it
+    is then created with the connected socket, and never listens itself.
+
+    netbeanSession = NetbeanServer( conn=conn, netbeanPwd=pwd )
     '''
 
     def __init__(self, **kwargs ):
@@ -43,6 +86,8 @@ class NetbeanServer( MyTcpServer ):
         self.netbeanPort = kwargs.get('netbeanPort', NETBEAN_PORT)
 
         self.server = MyTcpServer.__init__(self, self.netbeanPort )
+        if kwargs.get('conn'):
+            self.useConnection( kwargs['conn'] )
 
         if self.netbeanPwd == '':
             self.netbeanPwd = ''.join( [ random.choice('abcdefghijklmnopqrstuvwxyz') for i in range(8) ] )
@@ -51,8 +96,9 @@ class NetbeanServer( MyTcpServer ):
         self.startupDone = False
         self.startupDelayedCmd = []
         self.seqId = 0
-        self.waitForReply = None
-        self.replyInfo = None
+        self.pendingReplies = {}    # seqId -> NetbeanReply
+        self.batchLevel = 0
+        self.outQueue = []          # commands not written yet
 
         self.eventHandlerList = []
 
@@ -71,12 +117,27 @@ class NetbeanServer( MyTcpServer ):
         MyTcpServer.startServer( self )
         self.netbeanPort = self.port
 
-    def waitStartupDone( self ):
-        '''Wait until startup is finished.'''
+    def waitStartupDone( self, timeout=None ):
+        '''Wait until startup is finished, at most timeout seconds, forever
+        if timeout is None. Return True if startup is finished.'''
         dbg('...')
+        deadline = time.time() + (timeout or 0)
         while not (self.authDone and self.startupDone):
-            self.processRequest(True) # blocking
+            if timeout is None:
+                self.processRequest(True) # blocking
+                continue
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                dbg( 'Timeout' )
+                return False
+            self.flush()
+            line = self.readLine( remaining )
+            if line:
+                self.handleLine( line )
+            elif not self.isConnected():
+                raise NetbeanProtocolError( 'Connection closed before startup' )
         dbg('Done')
+        return True
 
     #######################################################################
     #                               Inherited
@@ -102,43 +163,9 @@ class NetbeanServer( MyTcpServer ):
         and then return it, or wait until socket is closed and then
         return an empty line.
         '''
-        while 1:
-            try:
-                line = self.rfile.readline()[:-1]
-                return line
-
-            except socket.timeout, v:
-                if blocking:
-                    time.sleep( 0.1 )
-                    continue
-                else:
-                    # no data was available
-                    return ''
-
-            except socket.error, v:
-                # this is probably not portable, but no other solution available
-                # python doc says that the error in that case is OS dependent.
-                # need to add errno values for Linux and MacOS...
-
-                if type(v) == type((1,2)):
-                    eno, msg = v
-                    if eno == errno.EWOULDBLOCK:
-                        if blocking:
-                            time.sleep( 0.1 )
-                            continue
-                        else:
-                            # no data was available
-                            return ''
-                    else:
-                        err( "Read error from socket: eno=%s" % str(eno) )
-                        return ''
-                else:
-                    err( "Read error from socket: %s" % str(v) )
-                    return ''
-
-            except IOError, e:
-                # IOError occurs when socket has closed
-                return ''
+        if blocking:
+            return self.readLine( None )
+        return self.readLine( 0 )
 
     def processRequest(self, blocking=True):
         '''Handle 0 or 1 request.
@@ -147,9 +174,13 @@ class NetbeanServer( MyTcpServer ):
         '''
 
         # deepdbg('Waiting for request (%s) ...' % { False: 'non blocking', True:'blocking' }[blocking] )
-        if self.rfile == None or self.wfile == None or not self.isConnected():
+        if self.conn == None or self.wfile == None or not self.isConnected():
             raise NetbeanProtocolError( 'Server has not accepted connections yet.' )
 
+        if blocking:
+            # what we wait for may depend on the queued commands
+            self.flush()
+
         line = self.readOneLine( blocking )
 
         if line == '':
@@ -160,6 +191,11 @@ class NetbeanServer( MyTcpServer ):
 
             return 0
 
+        self.handleLine( line )
+        return 1
+
+    def handleLine( self, line ):
+        '''Dispatch the line received from vim to its handler.'''
         dbg( 'Handling: \'%s\'' % line )
 
         mo = None
@@ -171,7 +207,6 @@ class NetbeanServer( MyTcpServer ):
 
         if not mo:
             dbg( 'Could not find handler for: %s', line )
-        return 1
 
     def processVimEvents( self, nbEvents=-1 ):
         '''Call this function regularly to receive all events sent by vim and disptach them
@@ -224,12 +259,13 @@ class NetbeanServer( MyTcpServer ):
         args = mo.group(3) or ''
         dbg( 'Reply: seqId=%d, args=\'%s\'', seqId, args )
 
-        if self.waitForReply != seqId:
-            msg = 'Received reply for seqId %d while waiting for seqId %d' % (seqId, self.waitForReply)
+        reply = self.pendingReplies.pop( seqId, None )
+        if reply is None:
+            msg = 'Received reply for seqId %d while waiting for seqId %s' % (seqId, sorted( self.pendingReplies.keys() ))
             err( msg )
             raise NetbeanProtocolError( msg )
 
-        self.replyInfo = args
+        reply.set( args )
 
 
     reEvent = re.compile( '(\\d+):(\\w+)=(\\d+)(\\s+(.*))*' )
@@ -256,7 +292,8 @@ class NetbeanServer( MyTcpServer ):
         '''Add a function to be called when an event arrives from Vim.
 
         Protocol events are already handled by this class (version, startupDone, ...). The
-        events that are passed here are editor events (new buffer, ...).
+        events that are passed here are editor events (new buffer, ...), and
+        startupDone once this class has handled it.
 
         The signature of f must be: f( eventBufId, eventName, eventArgs) with
         - eventBufId: number, buffer id
@@ -268,10 +305,15 @@ class NetbeanServer( MyTcpServer ):
     def handleEventStartupDone( self, bufId, name, seqId, args ): 
         dbg( 'Vim Startup event received.' )
         self.startupDone = True
-        for c in self.startupDelayedCmd:
-            dbg( 'Sending delayed commands: %s', c )
-            self.sendStr( c )
+        self.startBatch()
+        try:
+            for c in self.startupDelayedCmd:
+                dbg( 'Sending delayed commands: %s', c )
+                self.sendStr( c )
+        finally:
+            self.endBatch()
         self.startupDelayedCmd = []
+        self._notifyEvent( bufId, name, args )
 
     def handleEventVersion( self, bufId, name, seqId, args ):
         version = args.strip()[1:-1]
@@ -315,7 +357,34 @@ class NetbeanServer( MyTcpServer ):
             if force: forceMsg = '(by force)' 
             else: forceMsg = ''
             dbg( "Sending command %s '%s' to GVim" % (forceMsg, cmd) )
-            self.wfile.write(cmd + '\n')
+            self.outQueue.append( cmd + '\n' )
+            if force or not self.batchLevel:
+                self.flush()
+
+    def startBatch( self ):
+        '''Queue the commands sent until the matching endBatch(), and write
+        them to vim at once. Batches may be nested.'''
+        self.batchLevel += 1
+
+    def endBatch( self ):
+        '''End a batch started with startBatch(), flush the queued commands
+        at the end of the outermost batch.'''
+        self.batchLevel -= 1
+        if self.batchLevel == 0:
+            self.flush()
+
+    def flush( self ):
+        '''Write the queued commands to vim, in a single write.'''
+        if self.outQueue:
+            data = ''.join( self.outQueue )
+            self.outQueue = []
+            try:
+                self.wfile.write( data )
+            except (IOError, socket.error), e:
+                self.connected = False
+                msg = 'Write error to vim: %s' % str( e )
+                err( msg )
+                raise NetbeanProtocolError( msg )
 
     def sendCmd(self, bufId, cmd, *args ): 
         '''Send a command to gvim.
@@ -323,6 +392,17 @@ class NetbeanServer( MyTcpServer ):
         self.seqId += 1
         self.sendStr("%d:%s!%d%s" % (bufId, cmd, self.seqId, packArgs( *args )))
 
+    def sendRequest( self, bufId, cmd, *args ):
+        '''Send the command to gvim without waiting for its reply.
+
+        Raises an exception if not authenticated or if startup is not done.
+
+        Return a NetbeanReply, whose result() is the reply string. Several
+        requests may be sent before their replies are collected: the replies
+        come back in one round-trip.
+        '''
+        return self._sendRequest( bufId, cmd, None, *args )
+
     def sendCmdWithReply( self, bufId, cmd, *args ):
         '''Send the command to gvim and process incoming events until a reply to the command
         is received.
@@ -331,34 +411,25 @@ class NetbeanServer( MyTcpServer ):
 
         Return the reply string.
         '''
-        
-        if not self.authDone or not self.startupDone:
-            msg = 'Trying to send \'%s\' but vim is not authententicated or has not started up.' % cmd
-            err( msg )
-            raise NetbeanProtocolError( msg )
+        return self.sendRequest( bufId, cmd, *args ).result()
 
-        
-        self.seqId += 1
-        self.sendStr("%d:%s/%d%s" % (bufId, cmd, self.seqId, packArgs( *args )) )
-        self.waitForReply = self.seqId
-        self.replyInfo = None
-
-        # in theory, we get a reply immediately but let's be precautious
-        infiniteLoopDetector = 300
-        while self.replyInfo == None:
-            dbg( 'Reply loop=%d' % infiniteLoopDetector )
-            # blocking request handler
-            self.processRequest( True )
-            infiniteLoopDetector -= 1
-            if infiniteLoopDetector == 0:
-                msg = 'Infinite loop while waiting for reply to \'%d\'' % self.waitForReply
+    def waitReply( self, reply ):
+        '''Process incoming events until the NetbeanReply reply is received.'''
+        while not reply.done:
+            if not self.isConnected():
+                msg = 'Connection closed while waiting for reply to \'%d\'' % reply.seqId
                 err( msg )
                 raise NetbeanProtocolError( msg )
+            # blocking request handler
+            self.processRequest( True )
 
-        # we have our reply in self.replyInfo
-        ret = self.replyInfo
-        self.replyInfo = None
-        return ret
+    def callAsync( self, bufId, cmd, replyFmt, *args ):
+        '''Send a command with a reply to Vim, without waiting for the reply.
+
+        Return a NetbeanReply, whose result() is the reply checked and
+        converted like call() does.
+        '''
+        return self._sendRequest( bufId, cmd, replyFmt, *args )
 
     def call( self, bufId, cmd, replyFmt, *args ):
         '''Send a command with a reply to Vim, check the reply value
@@ -381,12 +452,19 @@ class NetbeanServer( MyTcpServer ):
         In case of incorrect format specified, NetbeanProtocolError is raised.
         '''
         self.processVimEvents()
-        s = self.sendCmdWithReply( bufId, cmd, *args )
-        try:
-            ret = parseNetbeanArgs( s, replyFmt )
-            return ret
-        except ValueError:
-            raise NetbeanProtocolError( 'Unexpected response format: %s for format %s' % (s, replyFmt ) )
+        return self.callAsync( bufId, cmd, replyFmt, *args ).result()
+
+    def _sendRequest( self, bufId, cmd, replyFmt, *args ):
+        if not self.authDone or not self.startupDone:
+            msg = 'Trying to send \'%s\' but vim is not authententicated or has not started up.' % cmd
+            err( msg )
+            raise NetbeanProtocolError( msg )
+
+        self.seqId += 1
+        reply = NetbeanReply( self, self.seqId, replyFmt )
+        self.pendingReplies[ self.seqId ] = reply
+        self.sendStr("%d:%s/%d%s" % (bufId, cmd, self.seqId, packArgs( *args )) )
+        return reply
 
     def pingConnection( self ):
         '''Return True if connection is alive, else False.
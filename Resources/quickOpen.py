@@ -0,0 +1,228 @@
+import os
+import re
+import heapq
+import itertools
+import threading
+import binascii
+from xml.sax.saxutils import escape
+
+class QuickOpenIndex:
+    '''Fuzzy file name index for quick-open.
+
+    A query matches a file when its characters appear in order in the path of
+    the file, relative to the top folder. Matches in the file name rank
+    before matches in the rest of the path, contiguous and leading matches
+    rank first.
+
+    For every character, the index keeps a bitset of the files whose path
+    contains it, as a long integer. The candidates for a query are found by
+    ANDing the bitsets of its characters, and only the candidates are matched
+    against the query.
+
+    While a query is being typed, each new query extending the previous one
+    is only matched against the files which matched the previous one. Broad
+    queries stop once enough files contain the query in their name.
+
+    Files can be added and removed at any time: added files are kept in a
+    small unindexed tail, and removed files are masked out, until the tail
+    is big enough to rebuild the bitsets.
+
+    The index may be used from several threads.
+    '''
+
+    maxResults = 50
+    maxTail = 5000
+    # stop matching after this number of files containing the query in their name
+    maxNameMatches = 1000
+
+    def __init__( self ):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear( self, topdir='' ):
+        '''Empty the index, paths will be shown relative to topdir.'''
+        self.lock.acquire()
+        try:
+            self.topdir = topdir
+            self.paths = []         # relative path, None for removed files
+            self.lowPaths = []
+            self.idOfPath = {}
+            self.charBits = {}      # character -> bitset of the files containing it
+            self.indexedNb = 0      # files above this id are in the tail
+            self.removedBits = 0
+            self.lastQuery = None   # (needle, ids matching it, complete)
+        finally:
+            self.lock.release()
+
+    def fileNb( self ):
+        return len( self.idOfPath )
+
+    def addFiles( self, paths ):
+        '''Add the files paths, given as full paths.'''
+        self.lock.acquire()
+        try:
+            for path in paths:
+                rel = self._relPath( path )
+                if rel in self.idOfPath:
+                    continue
+                self.idOfPath[ rel ] = len( self.paths )
+                self.paths.append( rel )
+                self.lowPaths.append( rel.lower() )
+                self.lastQuery = None
+            if len( self.paths ) - self.indexedNb > self.maxTail:
+                self._rebuild()
+        finally:
+            self.lock.release()
+
+    def removeFiles( self, paths ):
+        '''Remove the files paths, given as full paths.'''
+        self.lock.acquire()
+        try:
+            for path in paths:
+                i = self.idOfPath.get( self._relPath( path ) )
+                if i is not None:
+                    self._remove( i )
+        finally:
+            self.lock.release()
+
+    def removeFolder( self, path ):
+        '''Remove all the files below the folder path.'''
+        self.lock.acquire()
+        try:
+            prefix = self._relPath( path ) + os.sep
+            for rel, i in self.idOfPath.items():
+                if rel.startswith( prefix ):
+                    self._remove( i )
+        finally:
+            self.lock.release()
+
+    def search( self, query, maxResults=None ):
+        '''Return the full paths of the best matches for query, best first.'''
+        chars = [ c for c in query.lower() if not c.isspace() ]
+        if not chars:
+            return []
+        pattern = re.compile( '.*?'.join( [ re.escape( c ) for c in chars ] ) )
+        needle = ''.join( chars )
+
+        self.lock.acquire()
+        try:
+            last = self.lastQuery
+            if last and last[2] and needle.startswith( last[0] ):
+                ids = [ i for i in last[1] if self.paths[i] is not None ]
+            else:
+                candidates = -1
+                for c in set( chars ):
+                    candidates &= self.charBits.get( c, 0 )
+                candidates &= ~self.removedBits
+                tail = [ i for i in range( self.indexedNb, len( self.paths ) )
+                         if self.paths[i] is not None ]
+                ids = itertools.chain( self._bits( candidates ), tail )
+            scored = []
+            matched = []
+            nameMatches = 0
+            complete = True
+            lowPaths = self.lowPaths
+            for i in ids:
+                score = self._score( needle, pattern, lowPaths[i] )
+                if score is None:
+                    continue
+                scored.append( (score, self.paths[i]) )
+                matched.append( i )
+                if score[0] == 3:
+                    nameMatches += 1
+                    if nameMatches >= self.maxNameMatches:
+                        complete = False
+                        break
+            self.lastQuery = (needle, matched, complete)
+        finally:
+            self.lock.release()
+
+        best = heapq.nlargest( maxResults or self.maxResults, scored )
+        return [ os.path.join( self.topdir, rel ) for score, rel in best ]
+
+    def resultsHtml( self, query ):
+        '''Return the matches for query as <li> items, the full path in their
+        title.'''
+        items = []
+        for path in self.search( query ):
+            folder, name = os.path.split( self._relPath( path ) )
+            items.append( '<li title="%s"><span class="file">%s</span> <span class="folderName">%s</span></li>' % (
+                escape( path ), escape( name ), escape( folder ) ) )
+        return ''.join( items )
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _relPath( self, path ):
+        '''Return path relative to topdir, path itself if it is not below.'''
+        if not self.topdir:
+            return path
+        prefix = os.path.join( self.topdir, '' )
+        if os.path.join( path, '' ) == prefix:
+            return ''
+        if path.startswith( prefix ):
+            return path[ len( prefix ): ]
+        return path
+
+    def _remove( self, i ):
+        del self.idOfPath[ self.paths[i] ]
+        self.paths[i] = None
+        self.lowPaths[i] = None
+        self.removedBits |= 1 << i
+
+    def _score( self, needle, pattern, lowPath ):
+        '''Return the (tier, score) of lowPath for the query, or None if it does
+        not match. Tiers, best first: 3 query in the name, 2 query spread
+        over the name, 1 query in the path, 0 query spread over the path.'''
+        name = lowPath[ lowPath.rfind( os.sep ) + 1: ]
+        pos = name.find( needle )
+        if pos >= 0:
+            return (3, - pos * 10 - len( name ))
+        mo = pattern.search( name )
+        if mo:
+            return (2, - (mo.end() - mo.start()) * 10 - len( name ))
+        pos = lowPath.find( needle )
+        if pos >= 0:
+            return (1, - len( lowPath ))
+        mo = pattern.search( lowPath )
+        if mo:
+            return (0, - (mo.end() - mo.start()) - len( lowPath ))
+        return None
+
+    def _rebuild( self ):
+        '''Index the tail and drop the removed files.'''
+        paths = [ p for p in self.paths if p is not None ]
+        self.paths = paths
+        self.lowPaths = [ p.lower() for p in paths ]
+        self.idOfPath = dict( [ (p, i) for i, p in enumerate( paths ) ] )
+        self.removedBits = 0
+        self.lastQuery = None
+
+        idsOfChar = {}
+        for i, low in enumerate( self.lowPaths ):
+            for c in set( low ):
+                idsOfChar.setdefault( c, [] ).append( i )
+        nbBytes = len( paths ) / 8 + 1
+        self.charBits = {}
+        for c, ids in idsOfChar.iteritems():
+            bits = bytearray( nbBytes )
+            for i in ids:
+                bits[ i >> 3 ] |= 1 << (i & 7)
+            bits.reverse()
+            self.charBits[ c ] = int( binascii.hexlify( bits ), 16 )
+        self.indexedNb = len( paths )
+
+    def _bits( self, mask ):
+        '''Generate the numbers of the bits set in mask.'''
+        h = '%x' % mask
+        top = len( h ) - 1
+        for i, c in enumerate( h ):
+            if c == '0':
+                continue
+            v = int( c, 16 )
+            base = (top - i) * 4
+            for b in (0, 1, 2, 3):
+                if v & (1 << b):
+                    yield base + b
+
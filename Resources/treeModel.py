@@ -0,0 +1,217 @@
+import os
+import bisect
+from array import array
+from xml.sax.saxutils import escape
+from treeOrder import TreeOrder
+
+FOLDER  = 1     # the node is a folder
+LOADED  = 2     # the content of the folder is in the model
+REMOVED = 4     # the node has been removed from the tree
+
+class TreeModel:
+    '''Compact model of the displayed tree.
+
+    Nodes are numbered in creation order, node 0 being the top folder. A node
+    only holds its name, the number of its parent folder and a few flags,
+    stored in arrays. Full paths are not stored but rebuilt from the parents
+    when needed, except for folders which are indexed by path.
+
+    The children of the loaded folders are kept as arrays of node numbers,
+    in display order: folders first, then files, each sorted with the
+    TreeOrder of the model. The sort keys of the children of a folder are
+    computed on the first insertion in the folder, and kept up to date from
+    there: an insertion is a bisection, without computing the keys again.
+
+    The HTML of a row is only generated when the row is rendered, with
+    rowHtml().
+    '''
+
+    def __init__( self, topdir=None ):
+        self.order = TreeOrder()
+        self.reset( topdir )
+
+    def reset( self, topdir ):
+        '''Clear the model, topdir becomes the top folder.'''
+        self.topdir = topdir
+        self.names = [ topdir ]
+        self.parents = array( 'i', [ -1 ] )
+        self.flags = array( 'B', [ FOLDER ] )
+        self.kids = {}                  # loaded folder -> array of children
+        self.keys = {}                  # loaded folder -> sort keys of its children
+        self.folders = { topdir: 0 }    # folder path -> node
+
+    def nodeNb( self ):
+        '''Return the number of nodes created since the last reset.'''
+        return len( self.names )
+
+    def name( self, node ):     return self.names[ node ]
+    def parent( self, node ):   return self.parents[ node ]
+    def isFile( self, node ):   return not self.flags[ node ] & FOLDER
+    def isLoaded( self, node ): return bool( self.flags[ node ] & LOADED )
+
+    def entry( self, node ):
+        '''Return the (isFile, name) sort key of node.'''
+        return (not self.flags[ node ] & FOLDER, self.names[ node ])
+
+    def path( self, node ):
+        '''Return the full path of node.'''
+        names = []
+        while node > 0:
+            names.append( self.names[ node ] )
+            node = self.parents[ node ]
+        names.append( self.topdir )
+        names.reverse()
+        return os.path.join( *names )
+
+    def folder( self, path ):
+        '''Return the node of the folder path, or None if it is not in the model.'''
+        return self.folders.get( path )
+
+    def children( self, node ):
+        '''Return the children of the folder node, or None if it is not loaded.'''
+        return self.kids.get( node )
+
+    def setChildren( self, node, dirs, files ):
+        '''Load the content of the folder node: dirs and files, in display order.
+
+        Return the array of the new children.
+        '''
+        base = self.path( node )
+        kids = array( 'i' )
+        for name in dirs:
+            kid = self._addNode( node, name, FOLDER )
+            self.folders[ os.path.join( base, name ) ] = kid
+            kids.append( kid )
+        for name in files:
+            kids.append( self._addNode( node, name, 0 ) )
+        self.kids[ node ] = kids
+        self.keys.pop( node, None )
+        self.flags[ node ] |= LOADED
+        return kids
+
+    def insertChild( self, node, name, isFile ):
+        '''Add name to the content of the loaded folder node, at its place in
+        display order. Return (newNode, position).'''
+        kids = self.kids[ node ]
+        path = self.path( node )
+        keys = self.keys.get( node )
+        if keys is None:
+            keys = self.keys[ node ] = [ self._sortKey( path, kid ) for kid in kids ]
+        key = (isFile, self.order.key( path, name ))
+        pos = bisect.bisect( keys, key )
+        keys.insert( pos, key )
+        flags = FOLDER
+        if isFile:
+            flags = 0
+        kid = self._addNode( node, name, flags )
+        if not isFile:
+            self.folders[ os.path.join( path, name ) ] = kid
+        kids.insert( pos, kid )
+        return kid, pos
+
+    def setOrder( self, order ):
+        '''Sort the content of the loaded folders with the TreeOrder order.
+        Each folder is sorted on its own: the tree keeps its shape.'''
+        self.order = order
+        self.keys = {}
+        for node, kids in self.kids.items():
+            path = self.path( node )
+            keyed = [ (self._sortKey( path, kid ), kid) for kid in kids ]
+            keyed.sort()
+            self.kids[ node ] = array( 'i', [ kid for key, kid in keyed ] )
+
+    def walkNodes( self, node=0 ):
+        '''Generate the nodes of the loaded subtree of node, in display order.'''
+        for kid in self.kids.get( node, [] ):
+            yield kid
+            if kid in self.kids:
+                for n in self.walkNodes( kid ):
+                    yield n
+
+    def removeChild( self, node, kid ):
+        '''Remove kid and its descendants from the folder node.
+
+        Return (nodes, folders): the removed nodes and the paths of the removed
+        folders.'''
+        kids = self.kids[ node ]
+        pos = kids.index( kid )
+        del kids[ pos ]
+        keys = self.keys.get( node )
+        if keys is not None:
+            del keys[ pos ]
+        nodes = []
+        folders = []
+        self._removeTree( kid, self.path( kid ), nodes, folders )
+        return nodes, folders
+
+    def clearChildren( self, node ):
+        '''Remove the content of the folder node, which is not loaded anymore.
+
+        Return (nodes, folders) like removeChild().'''
+        nodes = []
+        folders = []
+        path = self.path( node )
+        for kid in self.kids.pop( node, [] ):
+            self._removeTree( kid, os.path.join( path, self.names[ kid ] ), nodes, folders )
+        self.keys.pop( node, None )
+        self.flags[ node ] &= ~LOADED
+        return nodes, folders
+
+    def lastDescendant( self, node ):
+        '''Return the last node displayed in the subtree of node.'''
+        kids = self.kids.get( node )
+        while kids:
+            node = kids[ -1 ]
+            kids = self.kids.get( node )
+        return node
+
+    def rowHtml( self, node ):
+        '''Return the <tr> of node for the file table.
+
+        Loaded folders with content are marked as "parent". Folders which are
+        not loaded are marked as "parent lazy": treeTable draws an expander for
+        them, and their content is fetched when they are expanded.
+        '''
+        flags = self.flags[ node ]
+        classes = []
+        if flags & FOLDER:
+            kind = 'folder'
+            if not flags & LOADED:
+                classes.append( 'parent lazy' )
+            elif self.kids[ node ]:
+                classes.append( 'parent' )
+        else:
+            kind = 'file'
+        parent = self.parents[ node ]
+        if parent > 0:
+            classes.append( 'child-of-node-%d' % parent )
+        attr = ''
+        if classes:
+            attr = ' class="%s"' % ' '.join( classes )
+        return '<tr id="node-%d"%s><td><span class="%s" title="%s">%s</span></td></tr>' % (
+            node, attr, kind, escape( self.path( node ) ), escape( self.names[ node ] ) )
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _addNode( self, parent, name, flags ):
+        self.names.append( name )
+        self.parents.append( parent )
+        self.flags.append( flags )
+        return len( self.names ) - 1
+
+    def _sortKey( self, path, node ):
+        return (not self.flags[ node ] & FOLDER, self.order.key( path, self.names[ node ] ))
+
+    def _removeTree( self, node, path, nodes, folders ):
+        nodes.append( node )
+        if self.flags[ node ] & FOLDER:
+            folders.append( path )
+            self.folders.pop( path, None )
+            self.keys.pop( node, None )
+            for kid in self.kids.pop( node, [] ):
+                self._removeTree( kid, os.path.join( path, self.names[ kid ] ), nodes, folders )
+        self.flags[ node ] = REMOVED
+        self.names[ node ] = None
+
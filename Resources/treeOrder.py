@@ -0,0 +1,69 @@
+import os
+import re
+
+def nameKey( folder, name ):
+    return name
+
+reDigits = re.compile( r'(\d+)' )
+def naturalKey( folder, name ):
+    '''file2 before file10: runs of digits compare as numbers.'''
+    parts = reDigits.split( name.lower() )
+    for i in range( 1, len( parts ), 2 ):
+        parts[i] = int( parts[i] )
+    return parts
+
+def extensionKey( folder, name ):
+    return os.path.splitext( name )[1].lower()
+
+def sizeKey( folder, name ):
+    '''Biggest first.'''
+    try:
+        return -os.stat( os.path.join( folder, name ) ).st_size
+    except OSError:
+        return 0
+
+def mtimeKey( folder, name ):
+    '''Most recently modified first.'''
+    try:
+        return -os.stat( os.path.join( folder, name ) ).st_mtime
+    except OSError:
+        return 0
+
+orderKeys = {
+    'name':         nameKey,
+    'natural':      naturalKey,
+    'extension':    extensionKey,
+    'size':         sizeKey,
+    'mtime':        mtimeKey,
+}
+
+class TreeOrder:
+    '''The display order of the content of a folder.
+
+    The sub folders and the files of a folder are sorted separately, each
+    name being compared through a key computed once per sort. Equal keys are
+    sorted by name.
+
+    Orders are registered in orderKeys, as a function f( folder, name )
+    returning the key of name in folder.
+    '''
+
+    def __init__( self, name='name' ):
+        if name not in orderKeys:
+            raise ValueError( 'Unknown order: %s' % name )
+        self.name = name
+        self.keyFunc = orderKeys[ name ]
+
+    def key( self, folder, name ):
+        '''Return the complete sort key of name in folder.'''
+        return (self.keyFunc( folder, name ), name)
+
+    def sort( self, folder, names ):
+        '''Return names sorted. names must be sorted by name: the name order
+        returns it unchanged.'''
+        if self.keyFunc is nameKey:
+            return names
+        keyed = [ (self.keyFunc( folder, name ), name) for name in names ]
+        keyed.sort()
+        return [ name for key, name in keyed ]
+
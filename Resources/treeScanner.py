@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+
+from logSystem import *
+
+dbg = getLogger('TreeScanner').debug
+err = getLogger('TreeScanner').error
+
+# os.scandir() returns the file type read along with the directory entries
+# (d_type), which saves one stat() per entry. Use the backport on older
+# pythons, and plain listdir() + stat() as a last resort.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def scanDir( path ):
+    '''Return (dirs, files, links) for the directory path.
+
+    dirs and files are sorted lists of names, links is the list of the
+    folders of dirs which are symbolic links.
+
+    Raise OSError if path can not be read.
+    '''
+    dirs = []
+    files = []
+    links = []
+    if scandir:
+        for entry in scandir( path ):
+            try:
+                isDir = entry.is_dir()
+            except OSError:
+                isDir = False
+            if isDir:
+                dirs.append( entry.name )
+                if entry.is_symlink():
+                    links.append( entry.name )
+            else:
+                files.append( entry.name )
+    else:
+        for name in os.listdir( path ):
+            full_path = os.path.join( path, name )
+            if os.path.isdir( full_path ):
+                dirs.append( name )
+                if os.path.islink( full_path ):
+                    links.append( name )
+            else:
+                files.append( name )
+    dirs.sort()
+    files.sort()
+    return dirs, files, links
+
+
+class TreeScanner:
+    '''Scan a directory tree, top-down.
+
+    walk() yields (root, dirs, files) exactly like DirIndex.walk(), each
+    folder as soon as it has been read, so that the caller may show the
+    beginning of the walk while the rest is being read.
+
+    Unreadable folders are skipped. The folders whose read failed otherwise
+    are skipped too, and kept in errors as (path, exception).
+
+    If a TreeOrder is given, the dirs and files of each folder are sorted with
+    it, and the walk follows that order.
+
+    To use me:
+    scanner = TreeScanner( index )
+    for root, dirs, files in scanner.walk( topdir ):
+        ...
+    '''
+
+    def __init__( self, index, order=None ):
+        self.index = index
+        self.order = order
+        self.errors = []
+
+    def walk( self, topdir ):
+        '''Generate (root, dirs, files) for topdir and all its sub folders.'''
+        stack = [ topdir ]
+        while stack:
+            path = stack.pop()
+            result = self._read( path )
+            if result is None:
+                continue
+            dirs, files, links = result
+            yield path, dirs, files
+            subdirs = [ os.path.join( path, dir_ ) for dir_ in dirs if dir_ not in links ]
+            subdirs.reverse()
+            stack.extend( subdirs )
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _read( self, path ):
+        '''Return (dirs, files, links) of the folder path, sorted, or None if
+        it can not be read.'''
+        try:
+            dirs, files, links = self.index.listDirLinks( path )
+            if self.order:
+                dirs = self.order.sort( path, dirs )
+                files = self.order.sort( path, files )
+            return dirs, files, links
+        except OSError:
+            # unreadable folder, skipped by the walk
+            return None
+        except Exception, e:
+            err( 'Reading %s failed: %s', path, e )
+            self.errors.append( (path, e) )
+            return None
+
+
+def _benchmark( topdir ):
+    '''Compare the os.walk() traversal listup used to do with TreeScanner.'''
+    from dirIndex import DirIndex
+
+    t = time.time()
+    nb = 0
+    for root, dirs, files in os.walk( topdir ):
+        for name in dirs + files:
+            full_path = os.path.join( root, name )
+            nb += 1
+    tWalk = time.time() - t
+    print 'os.walk:                 %7.3f s for %d entries' % (tWalk, nb)
+
+    t = time.time()
+    nb = 0
+    for root, dirs, files in TreeScanner( DirIndex() ).walk( topdir ):
+        nb += len( dirs ) + len( files )
+    tScan = time.time() - t
+    print 'TreeScanner:             %7.3f s for %d entries, x%.2f' % (tScan, nb, tWalk / tScan)
+
+    index = DirIndex()
+    for root, dirs, files in TreeScanner( index ).walk( topdir ): pass
+    t = time.time()
+    for root, dirs, files in TreeScanner( index ).walk( topdir ): pass
+    print 'TreeScanner, indexed:    %7.3f s' % (time.time() - t)
+
+def _makeTree( topdir, nbDirs=2000, nbFiles=60 ):
+    '''Create a tree of nbDirs folders holding nbFiles files each.'''
+    for i in range( nbDirs ):
+        path = os.path.join( topdir, 'd%02d' % (i % 50), 'd%03d' % i )
+        os.makedirs( path )
+        for j in range( nbFiles ):
+            open( os.path.join( path, 'f%03d.txt' % j ), 'w' ).close()
+
+if __name__ == '__main__':
+    # python treeScanner.py [topdir]
+    # Without topdir, runs on a generated tree of 120k+ entries. Drop the
+    # system caches before running it to measure cold cache behavior.
+    import tempfile, shutil
+    if len( sys.argv ) > 1:
+        _benchmark( sys.argv[1] )
+    else:
+        topdir = tempfile.mkdtemp()
+        try:
+            _makeTree( topdir )
+            _benchmark( topdir )
+        finally:
+            shutil.rmtree( topdir )
+
@@ -0,0 +1,108 @@
+from array import array
+from xml.sax.saxutils import escape
+
+class TreeView:
+    '''The rows visible in a TreeModel, as a flat list of nodes.
+
+    The visible rows are the children of the top folder and, recursively, the
+    children of the expanded folders. Rows are addressed by their index in
+    that list, so that a viewport can ask for the rows it displays with
+    rowsHtml(), whatever the size of the tree.
+
+    Expanding or collapsing a folder only inserts or deletes the rows of its
+    visible content.
+    '''
+
+    indent = 19     # pixels per level, as treeTable
+
+    def __init__( self, model ):
+        self.model = model
+        self.reset()
+
+    def reset( self ):
+        '''Show the content of the top folder, all folders collapsed.'''
+        self.rows = array( 'i', self.model.children( 0 ) or [] )
+        self.expanded = {}
+
+    def rowNb( self ):
+        return len( self.rows )
+
+    def node( self, index ):
+        return self.rows[ index ]
+
+    def isExpanded( self, node ):
+        return node in self.expanded
+
+    def expand( self, index ):
+        '''Show the content of the folder at index, which must be loaded.'''
+        node = self.rows[ index ]
+        if node in self.expanded:
+            return
+        self.expanded[ node ] = True
+        self.rows[ index+1:index+1 ] = array( 'i', self._visible( node ) )
+
+    def collapse( self, index ):
+        '''Hide the content of the folder at index.'''
+        node = self.rows[ index ]
+        if node not in self.expanded:
+            return
+        count = len( list( self._visible( node ) ) )
+        del self.expanded[ node ]
+        del self.rows[ index+1:index+1+count ]
+
+    def toggle( self, index ):
+        if self.rows[ index ] in self.expanded:
+            self.collapse( index )
+        else:
+            self.expand( index )
+
+    def rebuild( self ):
+        '''Compute the visible rows again, after the model has changed.'''
+        expanded = self.expanded
+        self.expanded = {}
+        for node in expanded:
+            if self.model.children( node ) is not None:
+                self.expanded[ node ] = True
+        self.rows = array( 'i', self._visible( 0 ) )
+
+    def rowsHtml( self, start, count ):
+        '''Return the <tr> of the visible rows start to start+count.'''
+        return ''.join( [ self.rowHtml( i ) for i in range( start, min( start + count, len( self.rows ) ) ) ] )
+
+    def rowHtml( self, index ):
+        '''Return the <tr> of the visible row index. The expander and the
+        indentation are drawn here, the rows are not handled by treeTable.'''
+        model = self.model
+        node = self.rows[ index ]
+        depth = 0
+        parent = model.parent( node )
+        while parent > 0:
+            depth += 1
+            parent = model.parent( parent )
+        if model.isFile( node ):
+            kind = 'file'
+            attr = ''
+            expander = ''
+        else:
+            kind = 'folder'
+            if node in self.expanded:
+                attr = ' class="parent expanded"'
+            else:
+                attr = ' class="parent collapsed"'
+            expander = '<span style="margin-left: -%dpx; padding-left: %dpx" class="expander"></span>' % (
+                self.indent, self.indent )
+        return '<tr id="node-%d" data-row="%d"%s><td style="padding-left: %dpx">%s<span class="%s" title="%s">%s</span></td></tr>' % (
+            node, index, attr, self.indent * (depth + 1), expander, kind,
+            escape( model.path( node ) ), escape( model.name( node ) ) )
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _visible( self, node ):
+        for kid in self.model.children( node ) or []:
+            yield kid
+            if kid in self.expanded:
+                for n in self._visible( kid ):
+                    yield n
+
@@ -3,6 +3,7 @@ import random
 import subprocess 
 import time
 import os
+import re
 
 from logSystem import *
 
@@ -11,7 +12,112 @@ err = getLogger('VimLauncher').error
 
 class VimLauncherError( Exception ): pass
 
+class RemoteChannel:
+    '''A long-lived channel to the client-server functions of a remote Vim.
+
+    A vim is started once, in silent ex mode, and fed with remote_send() and
+    remote_expr() calls through its standard input, instead of starting a
+    vim --remote-send process for each call. The replies of remote_expr()
+    are printed by the ex mode vim on its standard output, one line each.
+
+    To use me:
+    channel = RemoteChannel( '/usr/bin/vim', 'VIM_WRAPPER123' )
+    channel.sendKeys( ':e foo<CR>' )
+    value = channel.evalExpr( 'bufnr("%")' )
+    channel.close()
+    '''
+
+    def __init__( self, vimExec, serverName ):
+        self.vimExec = vimExec
+        self.serverName = serverName
+        self.vim = None
+
+    def sendKeys( self, keys ):
+        '''Send the string keys to the remote Vim, in <> notation.'''
+        self._write( 'call remote_send(%s, %s)\n' % (vimString( self.serverName ), vimString( keys )) )
+
+    def evalExpr( self, expr ):
+        '''Eval expr on the remote Vim. Return the result of the evaluation,
+        as a string.'''
+        return self._eval( 'remote_expr(%s, %s)' % (vimString( self.serverName ), vimString( expr )), expr )
+
+    def hasClientServer( self ):
+        '''Return True if the vim of the channel has the client-server
+        functions. Without them, the keys sent are dropped silently.'''
+        return self._eval( "has('clientserver')", "has('clientserver')" ) == '1'
+
+    def close( self ):
+        if not self.vim:
+            return
+        try:
+            self.vim.stdin.write( 'qa!\n' )
+            self.vim.stdin.close()
+        except IOError:
+            pass
+        self.vim = None
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _eval( self, vimExpr, expr ):
+        '''Eval the expression vimExpr in the ex mode vim, expr being the
+        expression named in the errors.'''
+        # the result is put in the buffer of the ex mode vim and printed
+        # from there, escaped on a single line
+        self._write( '''silent! %%delete _
+try
+let r = '=' . %s
+catch
+let r = '!' . v:exception
+endtry
+put =substitute(escape(r, '\\'), nr2char(10), '\\\\n', 'g')
+1delete _
+1print
+''' % vimExpr )
+        line = self.vim.stdout.readline()
+        if not line:
+            raise VimLauncherError( 'Remote channel closed while evaluating "%s"' % expr )
+        value = re.sub( r'\\(.)', _unescapeChar, line.rstrip( '\r\n' )[1:] )
+        if line.startswith( '!' ):
+            raise VimLauncherError( 'Evaluating "%s" failed: %s' % (expr, value) )
+        return value
+
+    def _write( self, data ):
+        if self.vim is None:
+            cmdLine = [ self.vimExec, '-u', 'NONE', '-i', 'NONE', '-N', '-n', '-e', '-s' ]
+            dbg( 'Starting the remote channel: "%s"', str(cmdLine) )
+            self.vim = subprocess.Popen( cmdLine, shell=False,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE )
+        try:
+            self.vim.stdin.write( data )
+            self.vim.stdin.flush()
+        except IOError, e:
+            self.vim = None
+            raise VimLauncherError( 'Remote channel closed: %s' % str( e ) )
+
+def vimString( s ):
+    '''Return s as a Vim string expression.'''
+    return "'" + s.replace( "'", "''" ).replace( '\n', "' . nr2char(10) . '" ) + "'"
+
+def _unescapeChar( mo ):
+    if mo.group(1) == 'n':
+        return '\n'
+    return mo.group(1)
+
+
 class VimLauncher:
+    '''Launch gvim, and send it keys and expressions through a RemoteChannel.
+
+    The vim of the RemoteChannel is checked for client-server support when
+    first used. Without it, the keys and expressions are sent as before,
+    with a vimExec --remote-send or --remote-expr process for each call.
+
+    The keys sent before the Vim has started, that is until setReady() is
+    called when its netbeans startupDone event comes in, and the keys sent
+    between startBatch() and endBatch(), are queued and sent at once.
+    '''
+
     def __init__(self, **kwargs):
         '''Init the vim launcher.
 
@@ -21,20 +127,27 @@ class VimLauncher:
         - netbeanPort: port number of the netbean server. Default to 5678
         - netbeanHost: host on which the netbean server is running. Default to localhost.
         - useNetbean:  connect to a netbean host on startup
+        - remoteExec: path of the console vim used for the RemoteChannel.
+          Default to the vim next to vimExec, or to vimExec.
         '''
         self.vimExec = kwargs.get('vimExec', '')
         self.netbeanPwd = kwargs.get('netbeanPwd', '')
         self.netbeanPort = kwargs.get('netbeanPort', 5678)
         self.netbeanHost = kwargs.get('netbeanHost', 'localhost' )
         self.useNetbean = kwargs.get('useNetbean', True )
+        self.remoteExec = kwargs.get('remoteExec', '')
 
-        self.delayFirstCommand = 1 # 1 second by default
         self.serverName = 'VIM_WRAPPER'
         self.argServer = [ '--servername', self.serverName ]
 
         self.vim = None
         self.vimStarted = False
         self.startupTime = 0
+        self.remote = None
+        self.remoteChecked = False
+        self.ready = False
+        self.batchLevel = 0
+        self.keyQueue = []      # keys not sent yet
 
         if len(self.netbeanPwd) == 0:
             self.netbeanPwd = ''.join( [ 
@@ -73,6 +186,26 @@ class VimLauncher:
         dbg( 'Starting vim with: "%s"', str(vimCmdLine) )
         self.vim = subprocess.Popen( vimCmdLine, shell=False, env=env )
         self.vimStarted = True
+        self.ready = False
+        self.remote = RemoteChannel( self.findRemoteExecutable(), self.serverName )
+
+    def findRemoteExecutable( self ):
+        '''Return the vim used for the RemoteChannel: remoteExec if set, else
+        the console vim next to vimExec if there is one, else vimExec.'''
+        if self.remoteExec:
+            return self.remoteExec
+        folder, name = os.path.split( self.vimExec )
+        consoleName = re.sub( '^g', '', name )
+        if consoleName != name and os.path.exists( os.path.join( folder, consoleName ) ):
+            return os.path.join( folder, consoleName )
+        return self.vimExec
+
+    def setReady( self ):
+        '''Called when the Vim has started: send the queued keys.'''
+        dbg( 'Vim is ready' )
+        self.ready = True
+        if not self.batchLevel:
+            self.flushKeys()
 
     def isVimRunning( self ):
         if not self.vimStarted: return False
@@ -80,21 +213,40 @@ class VimLauncher:
         return (self.vim.returncode == None)
 
     def sendKeys( self, keys ):
-        '''Send the string keys to the remote Vim.'''
+        '''Send the string keys to the remote Vim, in <> notation.
+
+        The keys are queued until the Vim is ready, and during a batch.'''
         if not self.isVimRunning():
             raise VimLauncherError( 'Sending keys "%s" to a non running server' % keys )
 
-        vimCmdLine = [ self.vimExec ] + self.argServer + [ '--remote-send', keys ]
-
-        t = time.time()
-        deltaTime = t - self.startupTime
-        if deltaTime < self.delayFirstCommand:
-            deltaTime += 1
-            dbg( 'Sleeping %d s to give vim some time to start' % deltaTime )
-            time.sleep( deltaTime )
-
-        dbg( 'Sending key to vim: "%s"', keys )
-        subprocess.call( vimCmdLine )
+        self.keyQueue.append( keys )
+        if not self.ready:
+            dbg( 'Vim has not started, postponing keys "%s"', keys )
+        elif not self.batchLevel:
+            self.flushKeys()
+
+    def startBatch( self ):
+        '''Queue the keys sent until the matching endBatch(), and send them
+        at once. Batches may be nested.'''
+        self.batchLevel += 1
+
+    def endBatch( self ):
+        '''End a batch started with startBatch(), send the queued keys at the
+        end of the outermost batch if Vim is ready.'''
+        self.batchLevel -= 1
+        if self.batchLevel == 0 and self.ready:
+            self.flushKeys()
+
+    def flushKeys( self ):
+        '''Send the queued keys to the remote Vim, in a single remote_send().'''
+        if self.keyQueue:
+            keys = ''.join( self.keyQueue )
+            self.keyQueue = []
+            dbg( 'Sending key to vim: "%s"', keys )
+            if self._channel():
+                self.remote.sendKeys( keys )
+            else:
+                subprocess.call( [ self.vimExec ] + self.argServer + [ '--remote-send', keys ] )
 
     def sendKeysNormalMode( self, keys ):
         '''Send keys but ensure previously that vim is in normal mode to receive them.'''
@@ -102,17 +254,18 @@ class VimLauncher:
 
     def evalExpr( self, expr ):
         '''Eval expr on the remote Vim. Return the result of the evaluation.'''
-        raise VimLauncherError( 'Not working!' )
-
         if not self.isVimRunning():
             raise VimLauncherError( 'Sending expr "%s" to a non running server' % expr )
-
+        if not self.ready:
+            raise VimLauncherError( 'Sending expr "%s" to a server not started yet' % expr )
+
+        # the keys sent before are handled first
+        self.flushKeys()
+        dbg( 'Evaluating expr in vim: "%s"', expr )
+        if self._channel():
+            return self.remote.evalExpr( expr )
         vimCmdLine = [ self.vimExec ] + self.argServer + [ '--remote-expr', expr ]
-        dbg( 'Evaluating expr in vim: "%s"', vimCmdLine )
-        subprocess.call( vimCmdLine )
-
-        response = self.vim.stdout.readline()
-        return response
+        return subprocess.Popen( vimCmdLine, stdout=subprocess.PIPE ).communicate()[0].rstrip( '\r\n' )
 
     def shutDown( self ):
         '''Ask vim to quit.'''
@@ -120,8 +273,32 @@ class VimLauncher:
         dbg( 'Shutting down vim' )
 
         self.sendKeysNormalMode( ':q!<CR>' )
+        self.flushKeys()
+        if self.remote:
+            self.remote.close()
         self.vimStarted = False
 
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _channel( self ):
+        '''Return the RemoteChannel, None if its vim has no client-server
+        support.'''
+        if self.remote and not self.remoteChecked:
+            self.remoteChecked = True
+            try:
+                supported = self.remote.hasClientServer()
+            except VimLauncherError, e:
+                err( 'Remote channel failed: %s' % str( e ) )
+                supported = False
+            if not supported:
+                err( '%s has no client-server support, using %s --remote-send instead'
+                     % (self.remote.vimExec, self.vimExec) )
+                self.remote.close()
+                self.remote = None
+        return self.remote
+
 
 
 
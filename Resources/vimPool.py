@@ -0,0 +1,265 @@
+import threading
+import time
+
+from vimLauncher import VimLauncher, VimLauncherError
+from vimWrapper import VimWrapper
+from netbeanServer import NetbeanServer, NETBEAN_PORT
+from myTcpServer import MyTcpServer
+from logSystem import getLogger
+from bufferMgr import normPath
+
+dbg = getLogger('VimPool').debug
+err = getLogger('VimPool').error
+
+class VimPool:
+    '''A pool of Vim instances, connected to a single netbeans listening socket.
+
+    Each Vim is launched with its own password, which identifies its
+    connection when the AUTH line comes in. Every connection is a
+    NetbeanServer session driven by its own VimWrapper, with its own
+    BufferMgr: the commands sent to a Vim, and the replies waited for,
+    involve that Vim only, a slow or busy Vim does not stall the others.
+
+    Files are opened in the Vim which already has them, new files go to the
+    Vim with the fewest buffers.
+
+    startAsync() launches the Vim and returns at once, the connections being
+    accepted in a background thread until every Vim has sent startupDone:
+    the caller goes on meanwhile. The calls given to whenReady() before
+    then are queued, and made in order once the pool is ready. If a Vim does
+    not connect within connectTimeout seconds, the start fails and the
+    queued calls are dropped.
+
+    To use me:
+    vims = VimPool( vimExec=vimExec, size=2 )
+    vims.start()
+    vw, bufId = vims.openFile( path )
+    vw.setCurrentBufferLineCol( bufId, line, col )
+    '''
+
+    connectTimeout = 30
+
+    def __init__( self, **kwargs ):
+        '''Init the pool.
+
+        Keyword arguments:
+        - vimExec: path the vim executable file
+        - mirrorBuffers: given to the VimWrappers
+        - size: number of Vim launched by start(), 1 by default
+        '''
+        self.vimExec = kwargs['vimExec']
+        self.mirrorBuffers = kwargs.get( 'mirrorBuffers', False )
+        self.size = kwargs.get( 'size', 1 )
+        self.listener = None
+        self.vims = []          # VimWrapper of the connected Vim
+        self.launching = {}     # password -> VimLauncher of a Vim not connected yet
+        self.lock = threading.Lock()
+        self.readyEvent = threading.Event()
+        self.readyCalls = []    # (f, args) waiting for the pool to be ready
+        self.startError = None
+
+    def start( self ):
+        '''Start the listening socket and launch the Vim of the pool, return
+        when all of them have started.'''
+        self.startAsync()
+        self.waitReady()
+
+    def startAsync( self ):
+        '''Start the listening socket and launch the Vim of the pool, without
+        waiting for them to start.'''
+        dbg( '...' )
+        self.listener = MyTcpServer( NETBEAN_PORT )
+        self.listener.startServer()
+        for i in range( self.size ):
+            self.launchVim()
+        thread = threading.Thread( target=self._connectAll )
+        thread.setDaemon( True )
+        thread.start()
+
+    def isReady( self ):
+        '''Return True when all the Vim have started, False until then and
+        if the start failed.'''
+        return self.readyEvent.isSet() and not self.startError
+
+    def waitReady( self, timeout=None ):
+        '''Wait at most timeout seconds, forever if timeout is None, for all
+        the Vim to start, or for the start to fail. Return isReady().
+
+        Raise the error which stopped the start of the pool, if any.
+        '''
+        self.readyEvent.wait( timeout )
+        if self.startError:
+            raise self.startError
+        return self.isReady()
+
+    def whenReady( self, f, *args ):
+        '''Call f( *args ) now if the pool is ready, else once it is ready,
+        after the calls queued before. The call is dropped if the pool
+        failed to start.'''
+        self.lock.acquire()
+        try:
+            if self.startError:
+                err( 'Vim did not start, %s dropped' % f.__name__ )
+                return
+            if not self.isReady():
+                dbg( 'Vim not started yet, queuing %s', f.__name__ )
+                self.readyCalls.append( (f, args) )
+                return
+        finally:
+            self.lock.release()
+        f( *args )
+
+    def launchVim( self ):
+        '''Launch one more Vim, connecting to the pool. Its VimWrapper is
+        created by acceptVim() when it connects.'''
+        launcher = VimLauncher( vimExec=self.vimExec, netbeanPort=self.listener.port )
+        launcher.startVim()
+        self.launching[ launcher.netbeanPwd ] = launcher
+
+    def acceptVim( self, timeout=None ):
+        '''Wait for the connection of a launched Vim, at most timeout seconds
+        or forever if timeout is None, and as long again for its AUTH line.
+        Return its VimWrapper, or None if no Vim connected in time or if the
+        connection was refused.'''
+        conn = self.listener.acceptConnection( timeout )
+        if conn is None:
+            return None
+        server = NetbeanServer( conn=conn, netbeanPort=self.listener.port )
+        line = server.readLine( timeout )
+        mo = server.reAuth.match( line )
+        launcher = mo and self.launching.pop( mo.group(1).strip(), None )
+        if not launcher:
+            err( 'Connection refused, unexpected authentication: \'%s\'' % line )
+            server.closeServer()
+            return None
+        server.netbeanPwd = launcher.netbeanPwd
+        server.handleLine( line )
+
+        vw = VimWrapper( vimExec=self.vimExec, mirrorBuffers=self.mirrorBuffers )
+        vw.attach( server, launcher )
+        self.vims.append( vw )
+        return vw
+
+    def close( self ):
+        '''Close all the Vim and the listening socket.'''
+        for vw in self.vims:
+            vw.close()
+        self.vims = []
+        if self.listener:
+            self.listener.closeServer()
+
+    def processVimEvents( self ):
+        '''Process the events waiting from every Vim, without blocking. The
+        Vim whose connection is closed leave the pool.'''
+        for vw in self.vims[:]:
+            if vw.server.isConnected():
+                # reading the end of the connection closes it
+                vw.processVimEvents()
+            if not vw.server.isConnected():
+                dbg( 'Vim disconnected, removed from the pool' )
+                self.vims.remove( vw )
+
+    def vimOfPath( self, path ):
+        '''Return the VimWrapper of the Vim editing path, None if no Vim has it.'''
+        for vw in self.vims:
+            if vw.bufInfo.hasPath( path ):
+                return vw
+        return None
+
+    def chooseVim( self ):
+        '''Return the VimWrapper of the Vim with the fewest buffers.'''
+        if not self.vims:
+            raise IndexError( 'No Vim in the pool' )
+        return min( self.vims, key=lambda vw: vw.bufInfo.bufferNb() )
+
+    def openFile( self, path, vw=None ):
+        '''Open path in the Vim of the VimWrapper vw, chosen with chooseVim()
+        if None. A file already opened in a Vim is shown there instead.
+
+        Return (vw, bufId).
+        '''
+        self.processVimEvents()
+        opened = self.vimOfPath( path )
+        if opened:
+            bufId = opened.bufInfo.bufIdOfPath( path )
+            opened.setCurrentBuffer( bufId )
+            return opened, bufId
+        vw = vw or self.chooseVim()
+        return vw, vw.openFile( path )
+
+    def openFiles( self, paths ):
+        '''Open the files of paths, spreading the new ones over the Vim of the
+        pool so that they end up with as many buffers as possible. Each Vim
+        opens its files in a single batch.
+
+        Return a list of (vw, bufIds), one for each Vim involved.
+        '''
+        self.processVimEvents()
+        if not self.vims:
+            raise IndexError( 'No Vim in the pool' )
+        groups = [ [] for vw in self.vims ]
+        loads = [ vw.bufInfo.bufferNb() for vw in self.vims ]
+        chosen = {}     # normPath -> index of the Vim of the new files
+        for path in paths:
+            opened = self.vimOfPath( path )
+            if opened:
+                i = self.vims.index( opened )
+            elif normPath( path ) in chosen:
+                i = chosen[ normPath( path ) ]
+            else:
+                i = loads.index( min( loads ) )
+                loads[ i ] += 1
+                chosen[ normPath( path ) ] = i
+            groups[ i ].append( path )
+        return [ (vw, vw.openFiles( group )) for vw, group in zip( self.vims, groups ) if group ]
+
+    #######################################################################
+    #                         Private API
+    #######################################################################
+
+    def _connectAll( self ):
+        '''Accept the connections of the launched Vim and wait for their
+        startup, then make the queued calls.
+
+        The calls are made out of the lock, so that whenReady() does not
+        wait for them: the calls it queues meanwhile are made next.'''
+        try:
+            deadline = time.time() + self.connectTimeout
+            while self.launching:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise VimLauncherError( '%d Vim did not connect within %d seconds'
+                                            % (len( self.launching ), self.connectTimeout) )
+                self.acceptVim( remaining )
+            for vw in self.vims:
+                if not vw.server.waitStartupDone( max( 0, deadline - time.time() ) ):
+                    raise VimLauncherError( 'Vim did not start within %d seconds' % self.connectTimeout )
+            dbg( 'done' )
+        except Exception, e:
+            err( 'Vim did not start: %s' % str( e ) )
+            self.lock.acquire()
+            try:
+                self.startError = e
+                calls = self.readyCalls
+                self.readyCalls = []
+                self.readyEvent.set()
+            finally:
+                self.lock.release()
+            for f, args in calls:
+                err( 'Vim did not start, %s dropped' % f.__name__ )
+            return
+        while 1:
+            self.lock.acquire()
+            try:
+                calls = self.readyCalls
+                self.readyCalls = []
+                if not calls:
+                    self.readyEvent.set()
+                    return
+            finally:
+                self.lock.release()
+            for f, args in calls:
+                try:
+                    f( *args )
+                except Exception, e:
+                    err( 'Queued call to %s failed: %s' % (f.__name__, str( e )) )
@@ -1,8 +1,10 @@
 
+import time
 from vimLauncher import VimLauncher
-from netbeanServer import NetbeanServer, parseNetbeanArgs
+from netbeanServer import NetbeanServer, NetbeanProtocolError, parseNetbeanArgs
 from logSystem import getLogger
-from bufferMgr import BufferMgr
+from bufferMgr import BufferMgr, normPath
+from bufferText import BufferText
 
 dbg = getLogger('VimWrapper').debug
 
@@ -10,26 +12,40 @@ class VimWrapper:
     '''The frontend for wrapping vim. It will launch vim and initiate the netbean communication.
     
     It provides easy-to-use members to interact with vim, be notified about vim events, ...
+
+    The cursor position is cached: it is taken from the getCursor replies and
+    from the newDotAndMark events, which vim sends before the keyCommand
+    events. A cached position is used for cursorMaxAge seconds at most, and
+    is dropped when a command of ours moves the cursor. The cursor getters
+    take a refresh argument to ask vim anyway.
     '''
 
+    # seconds during which a cached cursor position is used
+    cursorMaxAge = 0.5
+
     def __init__(self, **kwargs):
         '''Init the vim wrapper.
 
         Keyword arguments: 
         - vimExec: path the vim executable file
+        - mirrorBuffers: if True, the text of the buffers given to
+          mirrorBuffer() is kept here, see mirrorBuffer()
         '''
         self.server = None
         self.vimLauncher = None
         self.vimExec = kwargs['vimExec']
+        self.mirrorBuffers = kwargs.get( 'mirrorBuffers', False )
         self.bufInfo = BufferMgr()
         self.ignoreNextOpenFile = 0
+        self.mirrors = {}   # bufId -> BufferText
+        self.cursor = None  # (time, bufId, line, col, offset), line and col may be None
 
     def start( self ):
         '''Start the netbean server and vim client.'''
         dbg( '...' )    
-        self.server = NetbeanServer()
-        self.server.startServer()
-        self.server.addEventHandler( self.eventReceived )
+        server = NetbeanServer()
+        server.startServer()
+        self.attach( server )
     
         self.vimLauncher = VimLauncher( vimExec=self.vimExec, netbeanPort=self.server.netbeanPort, netbeanPwd=self.server.netbeanPwd )
         self.vimLauncher.startVim()
@@ -38,10 +54,22 @@ class VimWrapper:
         self.server.waitStartupDone()
         dbg( 'done' )    
 
+    def attach( self, server, vimLauncher=None ):
+        '''Drive the vim connected to the NetbeanServer server, instead of
+        starting one with start().'''
+        self.server = server
+        self.server.addEventHandler( self.eventReceived )
+        if vimLauncher:
+            self.vimLauncher = vimLauncher
+
     def close( self ):
         '''Close vim and the netbean server.'''
         if self.server and self.server.isConnected():
-            self.server.sendDisconnect()
+            try:
+                self.server.sendDisconnect()
+            except NetbeanProtocolError:
+                # vim has gone already
+                pass
             self.server.closeServer()
         self.bufInfo.clear()
 
@@ -61,19 +89,38 @@ class VimWrapper:
 
     ##########  Buffer info, properties
 
-    def _getCursor( self ):
-        '''Return the current (bufId, cursorLine, cursorCol, cursorFileOffset ).'''
+    def _getCursor( self, needLineCol=True, refresh=False ):
+        '''Return the current (bufId, cursorLine, cursorCol, cursorFileOffset ).
+
+        The cached position is returned if it is recent enough, and holds the
+        line and column when needLineCol is set. Vim is asked otherwise, or
+        if refresh is set.'''
+        if not refresh:
+            # the pending events may update the position
+            self.processVimEvents()
+            cursor = self.cursor
+            if (cursor and time.time() - cursor[0] <= self.cursorMaxAge
+                and not (needLineCol and cursor[2] is None)):
+                return cursor[1:]
         s = self.server.call( 0, 'getCursor', 'NUM NUM NUM NUM')
+        self.cursor = (time.time(),) + s
         return s
 
-    def getBufId( self ): return self._getCursor()[0]
-    def getCursorLine( self ): return self._getCursor()[1]
-    def getCursorCol(  self ): return self._getCursor()[2]
-    def getCursorLineCol( self ): return self._getCursor()[1:3]
-    def getCursorOffset( self ): return self._getCursor()[3]
+    def _cursorMoved( self ):
+        '''Drop the cached cursor position, after a command moving the cursor.'''
+        self.cursor = None
+
+    def getBufId( self, refresh=False ): return self._getCursor( False, refresh )[0]
+    def getCursorLine( self, refresh=False ): return self._getCursor( True, refresh )[1]
+    def getCursorCol(  self, refresh=False ): return self._getCursor( True, refresh )[2]
+    def getCursorLineCol( self, refresh=False ): return self._getCursor( True, refresh )[1:3]
+    def getCursorOffset( self, refresh=False ): return self._getCursor( False, refresh )[3]
 
     def getLength( self, bufId ):
         '''Length of the content of the current buffer.'''
+        mirror = self._mirror( bufId )
+        if mirror:
+            return mirror.length()
         return self.server.call( bufId, 'getLength', 'NUM' )[0]
 
     def setModified( self, bufId, modified):
@@ -85,6 +132,23 @@ class VimWrapper:
         ret = self.server.call( bufId, 'getModified', 'NUM' )[0]
         return ret == 1
 
+    def bufferStates( self, bufIds ):
+        '''Return a dict bufId -> (length, modified) for the buffers bufIds.
+
+        The requests are all sent before the replies are read: the states
+        come back in one round-trip, whatever the number of buffers.'''
+        self.processVimEvents()
+        self.server.startBatch()
+        try:
+            replies = [ (bufId, self.server.callAsync( bufId, 'getLength', 'NUM' ),
+                         self.server.callAsync( bufId, 'getModified', 'NUM' )) for bufId in bufIds ]
+        finally:
+            self.server.endBatch()
+        states = {}
+        for bufId, length, modified in replies:
+            states[ bufId ] = (length.result()[0], modified.result()[0] == 1)
+        return states
+
     def numberBufferModified( self ):
         '''Return the number of currently modified buffer. When this number is 0
         it is safe to tell vim to exit.'''
@@ -93,19 +157,23 @@ class VimWrapper:
 
     def setCurrentBuffer( self, bufId ):
         '''Set bufId as the current buffer.'''
+        self._cursorMoved()
         self.server.sendCmd( bufId, 'setVisible', True )
 
     def setCurrentBufferByPath( self, path ):
         '''Set path as the current buffer.'''
         bufId = self.bufInfo.bufIdOfPath( path )
+        self._cursorMoved()
         self.server.sendCmd( bufId, 'setVisible', True )
 
     def setCurrentBufferOffset( self, bufId, offset ):
         '''Make bufId the current buffer and position the cursor at offset.'''
+        self._cursorMoved()
         self.server.sendCmd( bufId, 'setDot', offset )
 
     def setCurrentBufferLineCol( self, bufId, line, col ):
         '''Make bufId the current buffer and position the cursor at (line,col)'''
+        self._cursorMoved()
         self.server.sendCmd( bufId, 'setDot', (line,col) )
 
     def setBufferReadonly( self, bufId ):
@@ -117,8 +185,58 @@ class VimWrapper:
 
     def text( self, bufId ):
         '''Return the content of the buffer bufId.'''
+        mirror = self._mirror( bufId )
+        if mirror:
+            return mirror.text()
         return self.server.call( bufId, 'getText', 'STR' )[0]
 
+    def mirrorBuffer( self, bufId ):
+        '''Keep the text of the buffer bufId here, when mirrorBuffers is set,
+        else stop listening to its changes.
+
+        The text is fetched once, then kept in sync from the insert and remove
+        events Vim sends for the buffer: text(), getLength() and the offset
+        conversions of the buffer need no request to Vim anymore.'''
+        self.mirrorBufferList( [ bufId ] )
+
+    def mirrorBufferList( self, bufIds ):
+        '''mirrorBuffer() for all the buffers of bufIds, in one round-trip.
+        The buffers already mirrored are left as they are.'''
+        bufIds = [ bufId for bufId in bufIds if bufId not in self.mirrors ]
+        replies = []
+        self.server.startBatch()
+        try:
+            for bufId in bufIds:
+                if not self.mirrorBuffers:
+                    self.server.sendCmd( bufId, 'stopDocumentListen', True )
+                    continue
+                self.server.sendCmd( bufId, 'startDocumentListen' )
+                # the changes made from now on come after the reply
+                replies.append( (bufId, self.server.callAsync( bufId, 'getText', 'STR' )) )
+        finally:
+            self.server.endBatch()
+        for bufId, reply in replies:
+            self.mirrors[ bufId ] = BufferText( reply.result()[0] )
+
+    def offsetOfLineCol( self, bufId, line, col ):
+        '''Return the offset of (line, col) in the mirrored buffer bufId.'''
+        return self._mirror( bufId, True ).offsetOfLineCol( line, col )
+
+    def lineColOfOffset( self, bufId, offset ):
+        '''Return the (line, col) of offset in the mirrored buffer bufId.'''
+        return self._mirror( bufId, True ).lineColOfOffset( offset )
+
+    def _mirror( self, bufId, required=False ):
+        '''Return the up to date BufferText of bufId, None if bufId is not mirrored.'''
+        mirror = self.mirrors.get( bufId )
+        if mirror is None:
+            if required:
+                raise KeyError( 'Buffer %d is not mirrored' % bufId )
+            return None
+        # apply the changes received so far
+        self.processVimEvents()
+        return self.mirrors.get( bufId )
+
     def insertText( self, bufId, offset, text ):
         '''Make bufId the current buffer and insert text at the offset.
 
@@ -126,7 +244,12 @@ class VimWrapper:
         must be changed explicitely.
 
         Return: None on success, message on failure.'''
-        return self.server.call( bufId, 'insert', 'OPTMSG', offset, text )[0]
+        self._cursorMoved()
+        ret = self.server.call( bufId, 'insert', 'OPTMSG', offset, text )[0]
+        # vim does not send events for the changes made through netbeans
+        if ret is None and bufId in self.mirrors:
+            self.mirrors[ bufId ].insert( offset, text )
+        return ret
 
     def removeText( self, bufId, offset, length ):
         '''Delete text starting from offset, up to length. Make bufId the current buffer.
@@ -136,7 +259,11 @@ class VimWrapper:
 
         Return None upon success, or an error message upon failure.
         '''
-        return self.server.call( bufId, 'remove', 'OPTMSG', offset, length )[0]
+        self._cursorMoved()
+        ret = self.server.call( bufId, 'remove', 'OPTMSG', offset, length )[0]
+        if ret is None and bufId in self.mirrors:
+            self.mirrors[ bufId ].remove( offset, length )
+        return ret
 
 
     ########## Buffer manipulation
@@ -148,30 +275,83 @@ class VimWrapper:
         '''
         bufId = self.bufInfo.createBufId()
         self.ignoreNextOpenFile += 1
-        self.server.sendCmd( bufId , 'editFile', path )
-        self.processVimEvents()
-        self.server.sendCmd( bufId, 'setFullName', path )
-        self.server.sendCmd( bufId, 'initDone' )
+        self._cursorMoved()
+        self.server.startBatch()
+        try:
+            self.server.sendCmd( bufId , 'editFile', path )
+            self.processVimEvents()
+            self.server.sendCmd( bufId, 'setFullName', path )
+            self.server.sendCmd( bufId, 'initDone' )
+        finally:
+            self.server.endBatch()
         self.bufInfo.addBuffer( bufId, path )
         return bufId
 
+    def openFiles( self, paths ):
+        '''Open the specified files at once.
+
+        The bufIds are allocated first, then the commands of all the files are
+        sent in a single batch, ended by a request for the cursor: its reply
+        comes after the fileOpened events of the files, which are processed
+        while waiting for it. The files already opened keep their buffer, the
+        spellings of a same path share one buffer.
+
+        Return the list of the bufIds of paths.
+        '''
+        bufIds = []
+        newBuffers = []
+        newBufIds = {}      # normPath -> bufId of the new buffers
+        for path in paths:
+            if self.bufInfo.hasPath( path ):
+                bufIds.append( self.bufInfo.bufIdOfPath( path ) )
+                continue
+            key = normPath( path )
+            if key not in newBufIds:
+                newBufIds[ key ] = self.bufInfo.createBufId()
+                newBuffers.append( (newBufIds[ key ], path) )
+            bufIds.append( newBufIds[ key ] )
+        if not newBuffers:
+            return bufIds
+
+        self.ignoreNextOpenFile += len( newBuffers )
+        self._cursorMoved()
+        self.server.startBatch()
+        try:
+            for bufId, path in newBuffers:
+                self.server.sendCmd( bufId , 'editFile', path )
+                self.server.sendCmd( bufId, 'setFullName', path )
+                self.server.sendCmd( bufId, 'initDone' )
+            cursor = self.server.callAsync( 0, 'getCursor', 'NUM NUM NUM NUM' )
+        finally:
+            self.server.endBatch()
+        self.cursor = (time.time(),) + cursor.result()
+        self.processVimEvents()
+        for bufId, path in newBuffers:
+            self.bufInfo.addBuffer( bufId, path )
+        return bufIds
+
     def createBuffer( self, path ):
         '''Create a new buffer in Vim with the bufId specified. 
 
         Return the bufId of the new buffer.
         '''
         bufId = self.bufInfo.createBufId()
-
-        if 1:
-            self.server.sendCmd( bufId, 'create' )
-            self.server.sendCmd( bufId, 'setTitle', path )
-            self.server.sendCmd( bufId, 'setFullName', path )
-            self.server.sendCmd( bufId, 'initDone' )
-        else:
-            # optional alternative implemtation
-            self.server.sendCmd( bufId, 'editFile', path )
-            self.server.sendCmd( bufId, 'setFullpath', path )
-            self.server.sendCmd( bufId, 'initDone' )
+        self._cursorMoved()
+
+        self.server.startBatch()
+        try:
+            if 1:
+                self.server.sendCmd( bufId, 'create' )
+                self.server.sendCmd( bufId, 'setTitle', path )
+                self.server.sendCmd( bufId, 'setFullName', path )
+                self.server.sendCmd( bufId, 'initDone' )
+            else:
+                # optional alternative implemtation
+                self.server.sendCmd( bufId, 'editFile', path )
+                self.server.sendCmd( bufId, 'setFullpath', path )
+                self.server.sendCmd( bufId, 'initDone' )
+        finally:
+            self.server.endBatch()
 
         self.bufInfo.addBuffer( bufId, path )
         # fetch the fileOpened event
@@ -189,6 +369,8 @@ class VimWrapper:
         curBufId = self.getBufId()
         nextBufId = self.bufInfo.nextBuffer( bufId )
         self.bufInfo.rmBufferByBufId( bufId )
+        self.mirrors.pop( bufId, None )
+        self._cursorMoved()
         self.server.sendCmd( bufId, 'close' )
         if curBufId == bufId:
             self.setCurrentBuffer( nextBufId )
@@ -199,8 +381,12 @@ class VimWrapper:
 
     def saveBuffer( self, bufId ):
         '''Save the buffer and display message saved.'''
-        self.server.sendCmd( bufId, 'save' )
-        self.server.sendCmd( bufId, 'saveDone' ) # display 'buffer saved' in vim
+        self.server.startBatch()
+        try:
+            self.server.sendCmd( bufId, 'save' )
+            self.server.sendCmd( bufId, 'saveDone' ) # display 'buffer saved' in vim
+        finally:
+            self.server.endBatch()
 
     def saveAndExit( self ):
         '''Save all the modified buffers and tell vim to exit.
@@ -222,7 +408,8 @@ class VimWrapper:
         self.server.sendCmd( 0, 'specialKeys', keys )
  
     def sendKeys( self, keys ):
-        '''Send the key string keys to vim.'''
+        '''Send the key string keys to vim. The keys are sent once vim has
+        started.'''
         self.vimLauncher.sendKeys( keys )
 
     def sendKeysNormalMode( self, keys ):
@@ -266,11 +453,44 @@ class VimWrapper:
         self.assignBufId( bufId, path )
         self.bufInfo.addBuffer( bufId, path )
 
+    def eventStartupDone( self, bufId, name, args ):
+        if self.vimLauncher:
+            self.vimLauncher.setReady()
+
     def eventFileClosed( self, bufId, name, args ):
         dbg( '%d %s \'%s\'' % (bufId, name, args ) )
+        self.mirrors.pop( bufId, None )
         self.bufInfo.rmBufferByBufId( bufId )
         
 
+    def eventNewDotAndMark( self, bufId, name, args ):
+        '''The cursor position, sent before a keyCommand event. Only the
+        offset is given: the line and column are known for the mirrored
+        buffers only.'''
+        offset = parseNetbeanArgs( args, 'NUM NUM' )[0]
+        line = col = None
+        mirror = self.mirrors.get( bufId )
+        if mirror:
+            try:
+                line, col = mirror.lineColOfOffset( offset )
+            except IndexError:
+                pass
+        self.cursor = (time.time(), bufId, line, col, offset)
+
+    def eventInsert( self, bufId, name, args ):
+        '''Text inserted in a buffer, by the user.'''
+        mirror = self.mirrors.get( bufId )
+        if mirror:
+            offset, text = parseNetbeanArgs( args, 'NUM STR' )
+            mirror.insert( offset, text )
+
+    def eventRemove( self, bufId, name, args ):
+        '''Text removed from a buffer, by the user.'''
+        mirror = self.mirrors.get( bufId )
+        if mirror:
+            offset, length = parseNetbeanArgs( args, 'NUM NUM' )
+            mirror.remove( offset, length )
+
     def eventKeyAtPos( self, bufId, name, args ):
         '''Triggered when a netbeans hotkey is pressed along with <Pause>'''
         dbg( '%d %s \'%s\'' % (bufId, name, args ) )
@@ -283,10 +503,13 @@ class VimWrapper:
 
 
     eventMap = {
+        'startupDone':      eventStartupDone,
         'fileOpened':       eventFileOpened,
         'killed':           eventFileClosed,
-        'newDotAndMark':    eventIgnore,
+        'newDotAndMark':    eventNewDotAndMark,
         'keyCommand':       eventKeyCommand,
         'keyAtPos':         eventKeyAtPos,
+        'insert':           eventInsert,
+        'remove':           eventRemove,
     }
 